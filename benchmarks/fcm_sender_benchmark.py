@@ -0,0 +1,67 @@
+"""
+Throughput benchmark of the FirebaseClient against a local FakeFcmServer.
+
+    python -m benchmarks.fcm_sender_benchmark --users 50000 --chat-rooms 500 --latency 0.02
+"""
+
+import argparse
+import asyncio
+import time
+
+from server.clients.firebase_client import FirebaseClient
+from server.utils.fake_fcm_server import FakeFcmServer
+
+APPLICATION_IDENTIFIER = "benchmark-application"
+
+
+async def run_benchmark(users_count, chat_rooms_count, latency_sec, unavailable_ratio):
+    fake_fcm_server = FakeFcmServer(
+        latency_sec=latency_sec, unavailable_ratio=unavailable_ratio
+    )
+    url = await fake_fcm_server.start()
+
+    firebase_client = FirebaseClient(None, fcm_url=url)
+    await firebase_client.set_application_server_keys(
+        {APPLICATION_IDENTIFIER: fake_fcm_server.server_key}
+    )
+
+    device_message_list = []
+    for i in range(users_count):
+        chat_room_identifier = f"chat-room-{i % chat_rooms_count}"
+        message = {
+            "chat_room_identifier": chat_room_identifier,
+            "message": "Benchmark message",
+            "app_user_identifier": "benchmark-sender",
+            "click_action": "CHAT_NOTIFICATION",
+            "messages_count": 1,
+        }
+        device_message_list.append((f"token-{i}", message, APPLICATION_IDENTIFIER))
+
+    start = time.perf_counter()
+    result = await firebase_client.send_fcm_notifications(device_message_list)
+    elapsed = time.perf_counter() - start
+
+    await firebase_client.set_application_server_keys({})
+    await fake_fcm_server.stop()
+
+    print(
+        f"Sent {result.success_count} notifications ({result.failure_count} failed) "
+        f"in {fake_fcm_server.requests_count} requests: {elapsed:.3f}s, "
+        f"{result.success_count / elapsed:.0f} notifications/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--chat-rooms", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--unavailable-ratio", type=float, default=0.0)
+    args = parser.parse_args()
+    asyncio.run(
+        run_benchmark(args.users, args.chat_rooms, args.latency, args.unavailable_ratio)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Memory benchmark of the central router PresenceStore against the previous dict of websocket sets. The server
+bitmasks of PresenceStore alone (identifier -> bitmask dict) are compared with app user identifiers interned to
+integer ids (identifier -> id dict and an array of server bitmasks by id). PresenceStore also keeps the presence
+digests and the bucket index of every chat server.
+
+    python -m benchmarks.presence_store_benchmark --users 1000000 10000000 --chat-servers 16
+"""
+
+import argparse
+import array
+import gc
+import time
+import tracemalloc
+
+from dns.services.presence_store import PresenceStore
+
+
+class FakeChatServerWebsocket:
+    pass
+
+
+def build_dict_of_sets(application_user_identifiers, chat_server_websockets):
+    websockets_by_app_user_id = {}
+    for i, application_user_identifier in enumerate(application_user_identifiers):
+        websocket = chat_server_websockets[i % len(chat_server_websockets)]
+        if application_user_identifier not in websockets_by_app_user_id:
+            websockets_by_app_user_id[application_user_identifier] = set()
+        websockets_by_app_user_id[application_user_identifier].add(websocket)
+    return websockets_by_app_user_id
+
+
+def build_identifier_masks(application_user_identifiers, chat_server_websockets):
+    user_server_mask_dict = {}
+    server_id_dict = {
+        websocket: server_id
+        for server_id, websocket in enumerate(chat_server_websockets)
+    }
+    for i, application_user_identifier in enumerate(application_user_identifiers):
+        server_bit = (
+            1 << server_id_dict[chat_server_websockets[i % len(chat_server_websockets)]]
+        )
+        user_server_mask_dict[application_user_identifier] = (
+            user_server_mask_dict.get(application_user_identifier, 0) | server_bit
+        )
+    return user_server_mask_dict
+
+
+def build_interned_ids(application_user_identifiers, chat_server_websockets):
+    user_id_dict = {}
+    user_server_masks = array.array("Q")
+    server_id_dict = {
+        websocket: server_id
+        for server_id, websocket in enumerate(chat_server_websockets)
+    }
+    for i, application_user_identifier in enumerate(application_user_identifiers):
+        server_bit = (
+            1 << server_id_dict[chat_server_websockets[i % len(chat_server_websockets)]]
+        )
+        user_id = user_id_dict.get(application_user_identifier, None)
+        if user_id is None:
+            user_id_dict[application_user_identifier] = len(user_server_masks)
+            user_server_masks.append(server_bit)
+        else:
+            user_server_masks[user_id] |= server_bit
+    return user_id_dict, user_server_masks
+
+
+def build_presence_store(application_user_identifiers, chat_server_websockets):
+    presence_store = PresenceStore()
+    for i, application_user_identifier in enumerate(application_user_identifiers):
+        websocket = chat_server_websockets[i % len(chat_server_websockets)]
+        presence_store.add(application_user_identifier, websocket)
+    return presence_store
+
+
+def measure(build, application_user_identifiers, chat_server_websockets):
+    """
+    Returns the memory allocated by the structure (identifiers are allocated beforehand) and the build time.
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    structure = build(application_user_identifiers, chat_server_websockets)
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del structure
+    return memory, elapsed
+
+
+def run_benchmark(users_count, chat_servers_count):
+    # Identifiers like the ones of the Chat API, allocated once and shared by both structures
+    application_user_identifiers = [
+        f"{i:08x}-0000-4000-8000-000000000000" for i in range(users_count)
+    ]
+    chat_server_websockets = [
+        FakeChatServerWebsocket() for _ in range(chat_servers_count)
+    ]
+
+    for name, build in (
+        ("dict of sets", build_dict_of_sets),
+        ("identifier masks", build_identifier_masks),
+        ("interned ids", build_interned_ids),
+        ("PresenceStore", build_presence_store),
+    ):
+        memory, elapsed = measure(
+            build, application_user_identifiers, chat_server_websockets
+        )
+        print(
+            f"{users_count} users, {name}: {memory / 2**20:.0f} MiB, "
+            f"{memory / users_count:.0f} B/user, built in {elapsed:.2f}s"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, nargs="+", default=[1000000, 10000000])
+    parser.add_argument("--chat-servers", type=int, default=16)
+    args = parser.parse_args()
+    for users_count in args.users:
+        run_benchmark(users_count, args.chat_servers)
+
+
+if __name__ == "__main__":
+    main()
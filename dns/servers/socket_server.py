@@ -19,6 +19,7 @@ from dns.managers.connections_manager import ConnectionsManager
 from dns.services.central_router_message_manager import (
     DnsMessageManager,
 )
+from dns.services.compression_service import CompressionService
 from dns.services.email_exception_service import EmailExceptionService
 from dns.settings.settings import CENTRAL_ROUTER_INTERNAL_SECRET
 
@@ -34,6 +35,7 @@ class Context:
         self.connections_manager = ConnectionsManager(self)
         self.central_router_message_service = DnsMessageService(self)
         self.email_exception_service = EmailExceptionService(self)
+        self.compression_service = CompressionService(self)
 
 
 class DnsServer:
@@ -47,7 +49,12 @@ class DnsServer:
         )
 
         socket_server_task = asyncio.create_task(self.server_task(host, port))
-        await asyncio.gather(wait_for_websocket_servers_task, socket_server_task)
+        compression_stats_task = asyncio.create_task(
+            self.context.compression_service.handle()
+        )
+        await asyncio.gather(
+            wait_for_websocket_servers_task, socket_server_task, compression_stats_task
+        )
 
     async def server_task(self, host, port):
         try:
@@ -57,6 +64,8 @@ class DnsServer:
                 port,
                 create_protocol=DnsServerProtocol,
                 ping_timeout=None,
+                compression=None,
+                extensions=self.context.compression_service.get_extensions(),
             ) as ws_server:
                 # Using this trick to pass the context object to the DnsServerProtocol instance
                 self.server_socket = ws_server
@@ -1,6 +1,8 @@
 import json
 import logging
 
+from websockets.exceptions import WebSocketException
+
 from dns.services.message_type import MessageType
 
 LOGGER = logging.getLogger("Dns.DnsMessageService")
@@ -16,10 +18,17 @@ class DnsMessage:
 
     # Additional objects
     message_str = None
+    message_dict = None
 
 
 class DnsMessageManager:
 
+    # Messages of larger chat rooms (e.g. MASS chat rooms) carry only the app users of the chat server they are
+    # sent to, instead of all the app users of the chat room. Open issue: the chat server still sends all the app
+    # users of the chat room to the central router, which looks up every one of them, because there is no index
+    # of the chat rooms of an app user to keep chat room memberships at the central routers.
+    PER_SERVER_ROUTING_MIN_USERS_COUNT = 100
+
     def __init__(self, context):
         self.context = context
 
@@ -38,28 +47,48 @@ class DnsMessageManager:
             setattr(result, field, message_dict[field])
         return result
 
-    async def notify_server_sockets(
-        self, message_data, websocket, websockets_by_app_user_id
-    ):
-        chat_server_sockets_to_send = set()
-        offline_user_identifiers = set()
-
-        for user_identifier in message_data.application_user_identifiers:
-            # If user is NOT in the dict, we're assuming that user went offline and we ignore them (ie. we do not
-            # route anything). The chat service paradigm is that all users are online all the time! If someone
-            # goes offline, and then back online, they shall sync with the chat server, i.e. pull all unread messages
-            # in all chat rooms they're in.
-            if user_identifier in websockets_by_app_user_id:
-                for chat_server_socket in websockets_by_app_user_id[user_identifier]:
-                    if chat_server_socket not in chat_server_sockets_to_send:
-                        chat_server_sockets_to_send.add(chat_server_socket)
-            else:
-                if message_data.type == MessageType.ROUTABLE:
-                    offline_user_identifiers.add(user_identifier)
-
-        LOGGER.debug(f"Sending to {len(chat_server_sockets_to_send)} clients")
-        for socket in chat_server_sockets_to_send:
-            await socket.send(message_data.message_str)
+    async def notify_server_sockets(self, message_data, websocket, presence_store):
+        # If user is NOT in the presence store, we're assuming that user went offline and we ignore them (ie. we do
+        # not route anything). The chat service paradigm is that all users are online all the time! If someone
+        # goes offline, and then back online, they shall sync with the chat server, i.e. pull all unread messages
+        # in all chat rooms they're in.
+        if (
+            len(message_data.application_user_identifiers)
+            >= self.PER_SERVER_ROUTING_MIN_USERS_COUNT
+        ):
+            server_users, offline_users = presence_store.route_by_server(
+                message_data.application_user_identifiers
+            )
+            # The message without app users is encoded once, only the app users are encoded for every server
+            message_dict = dict(message_data.message_dict)
+            del message_dict["application_user_identifiers"]
+            message_prefix = json.dumps(message_dict)[:-1]
+            server_messages = [
+                (
+                    socket,
+                    f'{message_prefix}, "application_user_identifiers": {json.dumps(users)}}}',
+                )
+                for socket, users in server_users.items()
+            ]
+        else:
+            servers_mask, offline_users = presence_store.route(
+                message_data.application_user_identifiers
+            )
+            server_messages = [
+                (socket, message_data.message_str)
+                for socket in presence_store.get_websockets(servers_mask)
+            ]
+        offline_user_identifiers = (
+            set(offline_users) if message_data.type == MessageType.ROUTABLE else set()
+        )
+
+        LOGGER.debug(f"Sending to {len(server_messages)} clients")
+        for socket, message_str in server_messages:
+            try:
+                await socket.send(message_str)
+            except WebSocketException:
+                # Do not let one disconnecting chat server stop the others from getting the message
+                LOGGER.warning("Cannot send message to chat websocket server")
 
         if offline_user_identifiers:
             LOGGER.debug(
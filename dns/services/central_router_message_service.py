@@ -1,10 +1,14 @@
+import json
 import logging
 
+from websockets.exceptions import WebSocketException
+
 from dns.services.central_router_message_manager import (
     DnsMessageManager,
     DnsMessage,
 )
 from dns.services.message_type import MessageType
+from dns.services.presence_store import PresenceStore
 
 LOGGER = logging.getLogger("Dns.DnsService")
 
@@ -16,8 +20,8 @@ class DnsMessageService:
     """
 
     def __init__(self, context):
-        # The main map in form of Application_user_identifier -> {websocket, websocket, ....}
-        self.websockets_by_app_user_id = {}
+        # The main map of Application_user_identifier -> chat websocket servers of the user
+        self.presence_store = PresenceStore()
         # Messages handlers registry
         self.message_type_handlers = {
             MessageType.ADD_APP_USER_WEBSOCKET: self.add_app_user_websocket_message_handler,
@@ -26,6 +30,12 @@ class DnsMessageService:
             MessageType.SYSTEM_ROUTABLE: self.routable_message_handler,
             MessageType.FULL_SYNC: self.full_sync_message_handler,
             MessageType.SET_LAST_MESSAGE_READ: self.routable_message_handler,
+            MessageType.EPHEMERAL: self.routable_message_handler,
+            MessageType.INVALIDATE: self.invalidate_message_handler,
+            MessageType.PRESENCE_DIGEST: self.presence_digest_message_handler,
+            MessageType.PRESENCE_BUCKETS_SYNC: self.presence_buckets_sync_message_handler,
+            MessageType.DRAIN: self.drain_message_handler,
+            MessageType.DEFERRED_OFFLINE_NOTIFICATIONS: self.deferred_offline_notifications_message_handler,
         }
         self.context = context
         self.central_router_message_manager = DnsMessageManager(self.context)
@@ -53,20 +63,8 @@ class DnsMessageService:
             f"Updating add APPLICATION_USER_DICT with user: {message_data.application_user_identifier}"
         )
 
-        if (
-            message_data.application_user_identifier
-            not in self.websockets_by_app_user_id
-        ):
-            self.websockets_by_app_user_id[message_data.application_user_identifier] = (
-                set()
-            )
-
-        self.websockets_by_app_user_id[message_data.application_user_identifier].add(
-            websocket
-        )
-        LOGGER.debug(
-            f"APPLICATION_USER_DICT size is: {len(self.websockets_by_app_user_id)}"
-        )
+        self.presence_store.add(message_data.application_user_identifier, websocket)
+        LOGGER.debug(f"APPLICATION_USER_DICT size is: {len(self.presence_store)}")
 
     async def remove_app_user_websocket_message_handler(
         self, message, message_str, websocket
@@ -85,15 +83,8 @@ class DnsMessageService:
             f"Updating remove APPLICATION_USER_DICT with user: {message_data.application_user_identifier}"
         )
 
-        if message_data.application_user_identifier in self.websockets_by_app_user_id:
-            self.websockets_by_app_user_id[
-                message_data.application_user_identifier
-            ].remove(websocket)
-        if not self.websockets_by_app_user_id[message_data.application_user_identifier]:
-            del self.websockets_by_app_user_id[message_data.application_user_identifier]
-        LOGGER.debug(
-            f"APPLICATION_USER_DICT size is: {len(self.websockets_by_app_user_id)}"
-        )
+        self.presence_store.remove(message_data.application_user_identifier, websocket)
+        LOGGER.debug(f"APPLICATION_USER_DICT size is: {len(self.presence_store)}")
 
     async def routable_message_handler(self, message, message_str, websocket):
         # Format
@@ -108,6 +99,7 @@ class DnsMessageService:
             "application_user_identifiers"
         ]
         message_data.message_str = message_str
+        message_data.message_dict = message
 
         if message_data.type == MessageType.ROUTABLE:
             message_data.application_user_identifier = message["app_user_identifier"]
@@ -118,8 +110,118 @@ class DnsMessageService:
             f"Received routable message of type {message_data.type} from chat websocket server"
         )
         await self.central_router_message_manager.notify_server_sockets(
-            message_data, websocket, self.websockets_by_app_user_id
+            message_data, websocket, self.presence_store
+        )
+
+    async def invalidate_message_handler(self, message, message_str, websocket):
+        # Format
+        # {
+        #     'type': str,
+        #     'cache': str,
+        #     'identifiers': [str],
+        # }
+        # Cache invalidations are sent by the Chat API (system message socket) and broadcast to every chat server
+        if not websocket.is_system_message:
+            LOGGER.warning(
+                f"Rejected {message.get('cache', None)} invalidation from chat websocket server "
+                f"with identifier: {websocket.identifier}"
+            )
+            return
+        chat_server_websockets = list(
+            self.context.connections_manager.chat_server_websockets.values()
+        )
+        LOGGER.debug(
+            f"Broadcasting {message['cache']} invalidation to {len(chat_server_websockets)} chat websocket servers"
+        )
+        for chat_server_websocket in chat_server_websockets:
+            try:
+                await chat_server_websocket.send(message_str)
+            except WebSocketException:
+                # Do not let one disconnecting chat server stop the broadcast. Cache TTLs cover the lost message.
+                pass
+
+    async def presence_digest_message_handler(self, message, message_str, websocket):
+        # Format
+        # {
+        #     'type': str,
+        #     'buckets': [int],
+        # }
+        bucket_indexes = self.presence_store.get_mismatched_bucket_indexes(
+            websocket, message["buckets"]
+        )
+        if not bucket_indexes:
+            return
+        LOGGER.info(
+            f"Presence of chat websocket server differs in {len(bucket_indexes)} buckets"
+        )
+        await websocket.send(
+            json.dumps(
+                {
+                    "type": MessageType.PRESENCE_DIGEST_MISMATCH,
+                    "bucket_indexes": bucket_indexes,
+                }
+            )
+        )
+
+    async def presence_buckets_sync_message_handler(
+        self, message, message_str, websocket
+    ):
+        # Format
+        # {
+        #     'type': str,
+        #     'bucket_indexes': [int],
+        #     'application_user_identifiers': [str],
+        # }
+        added_users_count, removed_users_count = self.presence_store.sync_buckets(
+            websocket,
+            message["bucket_indexes"],
+            message["application_user_identifiers"],
         )
+        LOGGER.info(
+            f"Repaired presence of chat websocket server: {added_users_count} users added, "
+            f"{removed_users_count} users removed"
+        )
+
+    async def deferred_offline_notifications_message_handler(
+        self, message, message_str, websocket
+    ):
+        # Format
+        # {
+        #     'type': str,
+        #     'application_user_identifier': str,
+        #     'notifications': [{'chat_room_identifier': str, 'app_user_identifier': str, 'message': str}],
+        # }
+        # Sent after the app user was removed, when the resume window at the chat server ended
+        application_user_identifier = message["application_user_identifier"]
+        if application_user_identifier in self.presence_store:
+            LOGGER.debug(
+                f"User {application_user_identifier} reconnected to another chat websocket server, "
+                f"dropping deferred offline notifications"
+            )
+            return
+        for notification in message["notifications"]:
+            await websocket.send(
+                json.dumps(
+                    {
+                        "type": MessageType.OFFLINE_NOTIFICATION,
+                        "application_user_identifiers": [application_user_identifier],
+                        "chat_room_identifier": notification["chat_room_identifier"],
+                        "application_user_identifier": notification[
+                            "app_user_identifier"
+                        ],
+                        "message": notification["message"],
+                    }
+                )
+            )
+
+    async def drain_message_handler(self, message, message_str, websocket):
+        # Format
+        # {
+        #     'type': str,
+        # }
+        # The chat server is going to disconnect all of its users, so they are removed in one go
+        LOGGER.info("Chat websocket server is draining. Removing all of its users")
+        await self.close_chat_websocket_server_connection(websocket)
 
     async def full_sync_message_handler(self, message, message_str, websocket):
         # Format
@@ -137,29 +239,13 @@ class DnsMessageService:
         )
 
         for application_user_identifier in message_data.application_user_identifiers:
-            if application_user_identifier not in self.websockets_by_app_user_id:
-                self.websockets_by_app_user_id[application_user_identifier] = set()
-            self.websockets_by_app_user_id[application_user_identifier].add(websocket)
+            self.presence_store.add(application_user_identifier, websocket)
 
         # If central router is in operational mode, inform the websocket server about it
         await self.context.connections_manager.tell_them_if_i_am_ready(websocket)
 
     async def close_chat_websocket_server_connection(self, websocket):
-        removed_user_counter = 0
-        for (
-            application_user_identifier,
-            websockets,
-        ) in self.websockets_by_app_user_id.items():
-            if websocket in websockets:
-                self.websockets_by_app_user_id[application_user_identifier].remove(
-                    websocket
-                )
-                removed_user_counter += 1
-
-        # Keep only app user Id keys where value is a non-empty websocket set
-        self.websockets_by_app_user_id = {
-            k: v for k, v in self.websockets_by_app_user_id.items() if v
-        }
+        removed_user_counter = self.presence_store.remove_server(websocket)
         LOGGER.info(
             f"Dropped connection with websocket server. {removed_user_counter} users were removed"
         )
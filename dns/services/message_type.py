@@ -7,3 +7,10 @@ class MessageType:
     SET_LAST_MESSAGE_READ = "SET_LAST_MESSAGE_READ"
     OFFLINE_NOTIFICATION = "OFFLINE_NOTIFICATION"
     SYSTEM_ROUTABLE = "SYSTEM_ROUTABLE"
+    INVALIDATE = "INVALIDATE"
+    DRAIN = "DRAIN"
+    EPHEMERAL = "EPHEMERAL"
+    PRESENCE_DIGEST = "PRESENCE_DIGEST"
+    PRESENCE_DIGEST_MISMATCH = "PRESENCE_DIGEST_MISMATCH"
+    PRESENCE_BUCKETS_SYNC = "PRESENCE_BUCKETS_SYNC"
+    DEFERRED_OFFLINE_NOTIFICATIONS = "DEFERRED_OFFLINE_NOTIFICATIONS"
@@ -0,0 +1,196 @@
+from dns.services.presence_digest import PresenceDigest
+
+
+class PresenceStore:
+    """
+    Compact map of online app users to the chat websocket servers they are connected to. Every chat server gets a
+    small integer id, reused after it disconnects, and an app user identifier is mapped to a bitmask of server
+    ids. Most app users are connected to a single server, so no set is allocated per app user, and masks of the
+    first servers are small ints cached by the interpreter. Routing a message ORs the masks of its app users and
+    sends the message once to every server of the result. The PresenceDigest of the app users of every server is
+    kept up to date, so chat servers can detect and repair drift, and the app users of every server are indexed by
+    digest bucket, so a repair does not scan the whole map. App user identifiers are not interned to integer
+    ids: the id of every app user is an int object of its own, which costs more than it saves (see
+    benchmarks/presence_store_benchmark.py).
+    """
+
+    def __init__(self):
+        self.user_server_mask_dict = {}  # App user identifier -> bitmask of server ids
+        self.server_id_dict = {}  # Websocket -> server id
+        self.server_websockets = []  # Server id -> websocket (None if the id is free)
+        self.server_digests = []  # Server id -> PresenceDigest (object)
+        # Server id -> bucket index -> { App user identifier }
+        self.server_bucket_users = []
+        self.free_server_ids = []
+
+    def get_server_id(self, websocket):
+        server_id = self.server_id_dict.get(websocket, None)
+        if server_id is not None:
+            return server_id
+        if self.free_server_ids:
+            # Lowest ids first, so masks stay small
+            self.free_server_ids.sort(reverse=True)
+            server_id = self.free_server_ids.pop()
+            self.server_websockets[server_id] = websocket
+            self.server_digests[server_id] = PresenceDigest()
+            self.server_bucket_users[server_id] = self._create_bucket_users()
+        else:
+            server_id = len(self.server_websockets)
+            self.server_websockets.append(websocket)
+            self.server_digests.append(PresenceDigest())
+            self.server_bucket_users.append(self._create_bucket_users())
+        self.server_id_dict[websocket] = server_id
+        return server_id
+
+    def add(self, application_user_identifier, websocket):
+        server_id = self.get_server_id(websocket)
+        server_bit = 1 << server_id
+        mask = self.user_server_mask_dict.get(application_user_identifier, 0)
+        if mask & server_bit:
+            return
+        self.user_server_mask_dict[application_user_identifier] = mask | server_bit
+        bucket_index = self.server_digests[server_id].toggle(
+            application_user_identifier
+        )
+        self.server_bucket_users[server_id][bucket_index].add(
+            application_user_identifier
+        )
+
+    def remove(self, application_user_identifier, websocket):
+        server_id = self.server_id_dict.get(websocket, None)
+        mask = self.user_server_mask_dict.get(application_user_identifier, None)
+        if server_id is None or mask is None or not mask & (1 << server_id):
+            return
+        bucket_index = self.server_digests[server_id].toggle(
+            application_user_identifier
+        )
+        self.server_bucket_users[server_id][bucket_index].discard(
+            application_user_identifier
+        )
+        mask &= ~(1 << server_id)
+        if mask:
+            self.user_server_mask_dict[application_user_identifier] = mask
+        else:
+            del self.user_server_mask_dict[application_user_identifier]
+
+    def remove_server(self, websocket) -> int:
+        """
+        Removes the server from all app users. Returns the number of app users it was removed from.
+        """
+        server_id = self.server_id_dict.pop(websocket, None)
+        if server_id is None:
+            return 0
+        server_bit = 1 << server_id
+        removed_users_count = 0
+        for bucket_users in self.server_bucket_users[server_id]:
+            removed_users_count += len(bucket_users)
+            for application_user_identifier in bucket_users:
+                mask = self.user_server_mask_dict[application_user_identifier]
+                mask &= ~server_bit
+                if mask:
+                    self.user_server_mask_dict[application_user_identifier] = mask
+                else:
+                    del self.user_server_mask_dict[application_user_identifier]
+
+        self.server_websockets[server_id] = None
+        self.server_digests[server_id] = None
+        self.server_bucket_users[server_id] = None
+        self.free_server_ids.append(server_id)
+        return removed_users_count
+
+    def get_mismatched_bucket_indexes(self, websocket, buckets):
+        # Unknown servers are not allocated an id, e.g. a draining server which was removed at once. A server has
+        # an id as soon as it adds a user, so the digest of an unknown one is ignored
+        server_id = self.server_id_dict.get(websocket, None)
+        if server_id is None:
+            return []
+        return self.server_digests[server_id].get_mismatched_bucket_indexes(buckets)
+
+    def sync_buckets(
+        self, websocket, bucket_indexes, application_user_identifiers
+    ) -> (int, int):
+        """
+        Replaces the app users of the server in the buckets with the given ones. Returns the number of added and
+        removed app users.
+        """
+        # A server removed since its digest was compared is not added back
+        server_id = self.server_id_dict.get(websocket, None)
+        if server_id is None:
+            return 0, 0
+        server_bit = 1 << server_id
+        application_user_identifiers = set(application_user_identifiers)
+        bucket_users = self.server_bucket_users[server_id]
+        stale_users = [
+            application_user_identifier
+            for bucket_index in set(bucket_indexes)
+            for application_user_identifier in bucket_users[bucket_index]
+            if application_user_identifier not in application_user_identifiers
+        ]
+        for application_user_identifier in stale_users:
+            self.remove(application_user_identifier, websocket)
+
+        added_users_count = 0
+        for application_user_identifier in application_user_identifiers:
+            mask = self.user_server_mask_dict.get(application_user_identifier, 0)
+            if not mask & server_bit:
+                self.add(application_user_identifier, websocket)
+                added_users_count += 1
+        return added_users_count, len(stale_users)
+
+    @staticmethod
+    def _create_bucket_users():
+        return [set() for _ in range(PresenceDigest.BUCKETS_COUNT)]
+
+    def route(self, application_user_identifiers) -> (int, list):
+        """
+        Returns the bitmask of the servers of the app users and the app users which are offline.
+        """
+        servers_mask = 0
+        offline_users = []
+        for application_user_identifier in application_user_identifiers:
+            mask = self.user_server_mask_dict.get(application_user_identifier, 0)
+            if mask:
+                servers_mask |= mask
+            else:
+                offline_users.append(application_user_identifier)
+        return servers_mask, offline_users
+
+    def route_by_server(self, application_user_identifiers) -> (dict, list):
+        """
+        Returns the online app users of every server (websocket -> [app user identifier]) and the app users which
+        are offline.
+        """
+        server_users = {}
+        offline_users = []
+        for application_user_identifier in application_user_identifiers:
+            mask = self.user_server_mask_dict.get(application_user_identifier, 0)
+            if not mask:
+                offline_users.append(application_user_identifier)
+            server_id = 0
+            while mask:
+                if mask & 1:
+                    server_users.setdefault(server_id, []).append(
+                        application_user_identifier
+                    )
+                mask >>= 1
+                server_id += 1
+        return {
+            self.server_websockets[server_id]: users
+            for server_id, users in server_users.items()
+        }, offline_users
+
+    def get_websockets(self, servers_mask):
+        websockets = []
+        server_id = 0
+        while servers_mask:
+            if servers_mask & 1:
+                websockets.append(self.server_websockets[server_id])
+            servers_mask >>= 1
+            server_id += 1
+        return websockets
+
+    def __contains__(self, application_user_identifier):
+        return application_user_identifier in self.user_server_mask_dict
+
+    def __len__(self):
+        return len(self.user_server_mask_dict)
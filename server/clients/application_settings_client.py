@@ -1,13 +1,8 @@
 import logging
 
-import aiohttp
 import asyncio
 
-from server.settings.settings import (
-    CHAT_PERMISSION_HEADER,
-    CHAT_API_INTERNAL_SECRET,
-)
-from server.utils.utils import prepare_server_url, make_server_call
+from server.clients.chat_api_client import ChatApiException
 
 LOGGER = logging.getLogger("Server.ApplicationSettingsClient")
 
@@ -16,25 +11,54 @@ class ApplicationSettingsClient:
 
     def __init__(self, context):
         self.context = context
+        self.etag = None  # ETag of the last applied settings payload
+        self.refresh_event = asyncio.Event()
 
     async def handle(self):
         while True:
-            LOGGER.debug("Fetching application settings from django api.")
-            headers = {CHAT_PERMISSION_HEADER: CHAT_API_INTERNAL_SECRET}
-            async with aiohttp.ClientSession(headers=headers) as session:
-                url = prepare_server_url("applications/")
-                response = await make_server_call(session, url, method="get")
-
-                if response:
-                    self.context.applications_service.clear_application_settings()
-
-                    for application_dict in response["results"]:
-                        LOGGER.debug(
-                            f"Setting application settings for application: {application_dict}"
-                        )
-                        self.context.applications_service.set_application_settings(
-                            application_dict["identifier"], application_dict
-                        )
-
-                    self.context.offline_notification_client.firebase_client.reset_application_fcm_dict()
-            await asyncio.sleep(15 * 60)
+            self.refresh_event.clear()
+            try:
+                await self.refresh()
+            except Exception as e:
+                # The loop must keep running, or application settings are never refreshed again
+                LOGGER.exception(f"Cannot refresh application settings: {str(e)}")
+            try:
+                await asyncio.wait_for(self.refresh_event.wait(), timeout=15 * 60)
+            except asyncio.TimeoutError:
+                pass
+
+    def request_refresh(self):
+        """
+        Wakes up the refresh loop, used when settings were invalidated by the Chat API.
+        """
+        self.refresh_event.set()
+
+    async def refresh(self):
+        LOGGER.debug("Fetching application settings from django api.")
+        headers = {"If-None-Match": self.etag} if self.etag else None
+        try:
+            response = await self.context.chat_api_client.get(
+                "applications/", headers=headers
+            )
+        except ChatApiException as e:
+            LOGGER.warning(f"Cannot fetch application settings: {str(e)}")
+            return
+
+        if response.status == 304:
+            LOGGER.debug("Application settings did not change.")
+            return
+
+        applications_settings_dict = {}
+        for application_dict in response.data["results"]:
+            LOGGER.debug(
+                f"Setting application settings for application: {application_dict}"
+            )
+            applications_settings_dict[application_dict["identifier"]] = (
+                application_dict
+            )
+        self.context.applications_service.set_applications_settings(
+            applications_settings_dict
+        )
+        self.etag = response.headers.get("ETag", None)
+
+        await self.context.offline_notification_client.firebase_client.reset_application_fcm_dict()
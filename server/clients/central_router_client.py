@@ -2,18 +2,15 @@ import asyncio
 import json
 import logging
 
-import aiohttp
 import websockets
 from websockets.exceptions import WebSocketException
 
+from server.clients.chat_api_client import ChatApiException
 from server.settings.settings import (
     CENTRAL_ROUTER_INTERNAL_SECRET,
-    CHAT_API_INTERNAL_SECRET,
     CENTRAL_ROUTER_PERMISSION_HEADER,
     WEBSOCKET_SERVER_IDENTIFIER_HEADER,
-    CHAT_PERMISSION_HEADER,
 )
-from server.utils.utils import make_server_call, prepare_server_url
 
 LOGGER = logging.getLogger("Server.DnsClient")
 
@@ -37,6 +34,10 @@ class DnsClient:
     async def handle(self):
         while True:
             known_central_routers = await self._fetch_central_routers()
+            if known_central_routers is None:
+                # Keep the current connections when the list of routers is not available
+                await asyncio.sleep(120)
+                continue
             LOGGER.debug(f"Using list of {len(known_central_routers)} central routers")
 
             routers_to_connect_to = []
@@ -109,6 +110,8 @@ class DnsClient:
                         self.context.websocket_server_identifier,
                     ),
                 ],
+                compression=None,
+                extensions=self.context.compression_service.get_router_link_extensions(),
             ) as websocket:
 
                 await self._init_central_router_data(websocket, identifier)
@@ -139,6 +142,7 @@ class DnsClient:
         websocket.identifier = identifier
         self.router_socket_list.append(websocket)
         self.identifier_socket_dict[identifier] = websocket
+        self.context.central_router_message_service.invalidate_all_caches()
         await self.context.central_router_message_service.send_full_sync_message(
             websocket
         )
@@ -181,10 +185,11 @@ class DnsClient:
             del self.identifier_task_dict[identifier]
             await websocket.close()
 
-    @staticmethod
-    async def _fetch_central_routers():
+    async def _fetch_central_routers(self):
         LOGGER.info("Getting list of known central routers from the API")
-        headers = {CHAT_PERMISSION_HEADER: CHAT_API_INTERNAL_SECRET}
-        async with aiohttp.ClientSession(headers=headers) as session:
-            url = prepare_server_url("chat-central-router/")
-            return await make_server_call(session, url)
+        try:
+            response = await self.context.chat_api_client.get("chat-central-router/")
+        except ChatApiException as e:
+            LOGGER.warning(f"Cannot fetch list of known central routers: {str(e)}")
+            return None
+        return response.data
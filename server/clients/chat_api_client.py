@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import random
+import time
+
+import aiohttp
+
+from server.settings.settings import (
+    CHAT_API_INTERNAL_SECRET,
+    CHAT_PERMISSION_HEADER,
+)
+from server.utils.utils import prepare_server_url
+
+LOGGER = logging.getLogger("Server.ChatApiClient")
+
+
+class ChatApiException(Exception):
+    """
+    Raised when the Chat API is unavailable or returns an error response.
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class ChatApiResponse:
+
+    def __init__(self, status, data, headers):
+        self.status = status
+        self.data = data
+        self.headers = headers
+
+
+class CircuitBreaker:
+    """
+    Stops calling the Chat API for OPEN_SEC after FAILURE_THRESHOLD failed calls in a row. After that time a single
+    probe request is let through, and its result closes or reopens the circuit.
+    """
+
+    FAILURE_THRESHOLD = 5
+    OPEN_SEC = 30
+
+    def __init__(self):
+        self.failures_count = 0
+        self.opened_at = None
+        self.probe_in_progress = False
+
+    def allow_request(self):
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.OPEN_SEC or self.probe_in_progress:
+            return False
+        self.probe_in_progress = True
+        return True
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def end_probe(self):
+        self.probe_in_progress = False
+
+    def record_success(self):
+        self.failures_count = 0
+        self.opened_at = None
+        self.probe_in_progress = False
+
+    def record_failure(self):
+        self.failures_count += 1
+        self.probe_in_progress = False
+        if self.failures_count >= self.FAILURE_THRESHOLD:
+            if self.opened_at is None:
+                LOGGER.warning(
+                    f"Chat API failed {self.failures_count} times in a row. Opening the circuit breaker."
+                )
+            self.opened_at = time.monotonic()
+
+
+class ChatApiClient:
+    """
+    HTTP client shared by all background clients calling the Chat API. It keeps a pool of keep-alive connections,
+    retries failed GET calls with jittered exponential backoff and stops calling a failing Chat API endpoint at all
+    for a while (circuit breaker per path), so requests cannot pile up.
+    """
+
+    CONNECTIONS_LIMIT = 10
+    KEEPALIVE_TIMEOUT_SEC = 60
+    DEFAULT_TIMEOUT_SEC = 10
+    ENDPOINT_TIMEOUTS_SEC = {
+        "applications/": 30,
+        "chat-central-router/": 10,
+        "chat-server-status/report-status/": 5,
+        "chat-server-status/report-performance/": 10,
+    }
+    MAX_RETRIES = 3
+    RETRY_BACKOFF_SEC = 0.5
+    MAX_RETRY_BACKOFF_SEC = 10
+    IDEMPOTENT_METHODS = {"get"}
+
+    def __init__(self, context):
+        self.context = context
+        self.session = None
+        # Path -> CircuitBreaker (object), so a failing endpoint does not stop calls to the others
+        self.circuit_breaker_dict = {}
+
+    async def get(self, path, headers=None) -> ChatApiResponse:
+        return await self.request("get", path, headers=headers)
+
+    async def post(self, path, json=None) -> ChatApiResponse:
+        return await self.request("post", path, json=json)
+
+    async def request(self, method, path, headers=None, **kwargs) -> ChatApiResponse:
+        url = prepare_server_url(path)
+        timeout = aiohttp.ClientTimeout(
+            total=self.ENDPOINT_TIMEOUTS_SEC.get(path, self.DEFAULT_TIMEOUT_SEC)
+        )
+        circuit_breaker = self._get_circuit_breaker(path)
+        # A failed POST may have been applied by the Chat API anyway, so it is not sent twice
+        max_retries = self.MAX_RETRIES if method in self.IDEMPOTENT_METHODS else 0
+
+        attempt = 0
+        while True:
+            if not circuit_breaker.allow_request():
+                raise ChatApiException(
+                    f"Circuit breaker is open. Not calling the Chat API service {url}"
+                )
+
+            # Requests are only let through an open circuit as probes
+            is_probe = circuit_breaker.is_open()
+            try:
+                async with self._get_session().request(
+                    method, url, headers=headers, timeout=timeout, **kwargs
+                ) as resp:
+                    if resp.status < 500:
+                        circuit_breaker.record_success()
+                        return await self._prepare_response(resp, url)
+                    LOGGER.error(
+                        f"Internal server error (HTTP {resp.status}) in the Chat API service {url}"
+                    )
+                    error = ChatApiException(
+                        f"HTTP {resp.status} from the Chat API service {url}",
+                        resp.status,
+                    )
+            except aiohttp.ClientError as e:
+                LOGGER.warning(
+                    f"Cannot connect to the Chat API service at url: {url}: {str(e)}"
+                )
+                error = ChatApiException(str(e))
+            except asyncio.TimeoutError:
+                LOGGER.warning(
+                    f"Timeout when calling the Chat API service at url: {url}"
+                )
+                error = ChatApiException(f"Timeout when calling {url}")
+            finally:
+                if is_probe:
+                    # A cancelled probe must not keep the circuit open forever
+                    circuit_breaker.end_probe()
+
+            attempt += 1
+            # A failed probe is not retried, it reopens the circuit
+            if attempt > max_retries or is_probe:
+                # Counted once per call, not per attempt
+                circuit_breaker.record_failure()
+                raise error
+            # Full jitter, so chat servers do not retry in lockstep
+            await asyncio.sleep(
+                random.uniform(
+                    0,
+                    min(
+                        self.RETRY_BACKOFF_SEC * 2 ** (attempt - 1),
+                        self.MAX_RETRY_BACKOFF_SEC,
+                    ),
+                )
+            )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _get_circuit_breaker(self, path):
+        circuit_breaker = self.circuit_breaker_dict.get(path, None)
+        if circuit_breaker is None:
+            circuit_breaker = self.circuit_breaker_dict[path] = CircuitBreaker()
+        return circuit_breaker
+
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            # The session has to be created inside a running event loop
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.CONNECTIONS_LIMIT,
+                    keepalive_timeout=self.KEEPALIVE_TIMEOUT_SEC,
+                ),
+                headers={CHAT_PERMISSION_HEADER: CHAT_API_INTERNAL_SECRET},
+            )
+        return self.session
+
+    @staticmethod
+    async def _prepare_response(resp, url) -> ChatApiResponse:
+        if resp.status == 304:
+            return ChatApiResponse(resp.status, None, resp.headers)
+
+        try:
+            data = await resp.json(content_type=None)
+        except ValueError:
+            data = await resp.text()
+            if resp.status in (200, 201):
+                raise ChatApiException(
+                    f"Invalid JSON response from the Chat API service {url}: {data}",
+                    resp.status,
+                )
+        if resp.status not in (200, 201):
+            LOGGER.warning(
+                f"Error (HTTP {resp.status}) in the Chat API service {url}: {data}"
+            )
+            raise ChatApiException(
+                f"HTTP {resp.status} from the Chat API service {url}: {data}",
+                resp.status,
+            )
+        return ChatApiResponse(resp.status, data, resp.headers)
@@ -1,64 +1,207 @@
+import asyncio
 import json
 import logging
-from pyfcm import FCMNotification
+
+import aiohttp
 
 LOGGER = logging.getLogger("Server.FirebaseClient")
 
 
+class FcmSendResult:
+
+    def __init__(self):
+        self.success_count = 0
+        self.failed_tokens = {}  # Device fcm token -> FCM error, e.g. NotRegistered
+
+    @property
+    def failure_count(self):
+        return len(self.failed_tokens)
+
+    def add_failure(self, device_fcm_tokens, error):
+        for device_fcm_token in device_fcm_tokens:
+            self.failed_tokens[device_fcm_token] = error
+
+
+class FcmApplicationClient:
+    """
+    Keep-alive connection pool to FCM authorized with the server key of a single application.
+    """
+
+    CONNECTIONS_LIMIT = 20
+    KEEPALIVE_TIMEOUT_SEC = 60
+    REQUEST_TIMEOUT_SEC = 10
+
+    def __init__(self, server_key):
+        self.server_key = server_key
+        self.session = None
+
+    async def post(self, url, payload):
+        if self.session is None or self.session.closed:
+            # The session has to be created inside a running event loop
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.CONNECTIONS_LIMIT,
+                    keepalive_timeout=self.KEEPALIVE_TIMEOUT_SEC,
+                ),
+                headers={"Authorization": f"key={self.server_key}"},
+                timeout=aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT_SEC),
+            )
+        async with self.session.post(url, json=payload) as resp:
+            retry_after = resp.headers.get("Retry-After", None)
+            if resp.status != 200:
+                return resp.status, None, retry_after
+            return resp.status, await resp.json(), retry_after
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
 class FirebaseClient:
+    FCM_SEND_URL = "https://fcm.googleapis.com/fcm/send"
+    NOTIFICATION_TITLE = "New message from in chat room"
+
+    # FCM legacy HTTP API accepts up to 1000 registration ids in one request
+    MAX_MULTICAST_TOKENS = 1000
+    MAX_IN_FLIGHT_REQUESTS = 50
+    MAX_RETRIES = 3
+    RETRY_BACKOFF_SEC = 0.5
+    MAX_RETRY_AFTER_SEC = 30
+    RETRYABLE_ERRORS = {"Unavailable", "InternalServerError"}
 
-    def __init__(self, context):
+    def __init__(self, context, fcm_url=None):
         self.context = context
+        self.fcm_url = fcm_url or self.FCM_SEND_URL
         self.application_fcm_dict = (
             {}
-        )  # Application identifier -> FCMNotification (object)
+        )  # Application identifier -> FcmApplicationClient (object)
+        self.in_flight_semaphore = asyncio.Semaphore(self.MAX_IN_FLIGHT_REQUESTS)
+
+    async def send_fcm_notifications(self, device_message_list) -> FcmSendResult:
+        LOGGER.info(f"Sending {len(device_message_list)} fcm notifications")
+        result = FcmSendResult()
 
-    @staticmethod
-    def send_fcm_notifications(application_fcm_dict, device_message_dict):
-        LOGGER.info("Execution fcm notifications sync task")
-        for device_fcm_token, (
+        # Devices receiving exactly the same message are batched into a single multicast request.
+        # (Application identifier, message json) -> (message, [device fcm token])
+        multicast_dict = {}
+        for device_fcm_token, message, application_identifier in device_message_list:
+            key = (application_identifier, json.dumps(message, sort_keys=True))
+            if key not in multicast_dict:
+                multicast_dict[key] = (message, [])
+            multicast_dict[key][1].append(device_fcm_token)
+
+        tasks = []
+        for (application_identifier, _), (
             message,
-            application_identifier,
-        ) in device_message_dict.items():
-            try:
-                fcm = application_fcm_dict.get(application_identifier, None)
-                if not fcm:
-                    LOGGER.debug(
-                        f"Missing fcm token for application {application_identifier}"
+            device_fcm_tokens,
+        ) in multicast_dict.items():
+            fcm = self.application_fcm_dict.get(application_identifier, None)
+            if not fcm:
+                LOGGER.debug(
+                    f"Missing fcm token for application {application_identifier}"
+                )
+                result.add_failure(device_fcm_tokens, "MissingServerKey")
+                continue
+            for i in range(0, len(device_fcm_tokens), self.MAX_MULTICAST_TOKENS):
+                tasks.append(
+                    self._send_multicast(
+                        fcm,
+                        device_fcm_tokens[i : i + self.MAX_MULTICAST_TOKENS],
+                        message,
+                        result,
                     )
-                    continue
-                result = fcm.notify_single_device(
-                    registration_id=device_fcm_token,
-                    message_title="New message from in chat room",
-                    message_body=f"{message['message']}",
-                    data_message=message,
                 )
+        await asyncio.gather(*tasks)
 
-                LOGGER.debug(
-                    f"Sending message to device with fcm_token: {device_fcm_token}"
-                )
-                if not result["success"] and result["failure"]:
-                    # TODO What if fcm notification fail? Do we want to remove session from db?
-                    error_message = json.dumps(result["results"])
-                    LOGGER.error(f"Sending fcm notification failure: {error_message}")
+        if result.failed_tokens:
+            LOGGER.error(
+                f"Sending fcm notification failure for {result.failure_count} devices"
+            )
+        return result
 
-            except Exception as e:
-                LOGGER.error(f"Exception while sending fcm notification: {str(e)}")
+    async def _send_multicast(self, fcm, device_fcm_tokens, message, result):
+        payload = {
+            "notification": {
+                "title": self.NOTIFICATION_TITLE,
+                "body": f"{message['message']}",
+            },
+            "data": message,
+            # Newer notification for the same chat room replaces the older one on the device
+            "collapse_key": message["chat_room_identifier"],
+        }
+        attempt = 0
+        while True:
+            payload["registration_ids"] = device_fcm_tokens
+            status, response, retry_after = None, None, None
+            async with self.in_flight_semaphore:
+                try:
+                    status, response, retry_after = await fcm.post(
+                        self.fcm_url, payload
+                    )
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    LOGGER.warning(
+                        f"Exception while sending fcm notification: {str(e)}"
+                    )
 
-    def reset_application_fcm_dict(self):
-        application_fcm_dict = {}
+            if status == 200:
+                retry_device_fcm_tokens = []
+                for device_fcm_token, device_result in zip(
+                    device_fcm_tokens, response["results"]
+                ):
+                    error = device_result.get("error", None)
+                    if not error:
+                        result.success_count += 1
+                    elif error in self.RETRYABLE_ERRORS:
+                        retry_device_fcm_tokens.append(device_fcm_token)
+                    else:
+                        result.add_failure([device_fcm_token], error)
+                device_fcm_tokens = retry_device_fcm_tokens
+            elif status is not None and status < 500 and status != 429:
+                # Bad request or invalid server key, retrying will not help
+                LOGGER.error(f"FCM rejected notification request with HTTP {status}")
+                result.add_failure(device_fcm_tokens, f"HTTP{status}")
+                return
+
+            if not device_fcm_tokens:
+                return
+            attempt += 1
+            if attempt > self.MAX_RETRIES:
+                result.add_failure(device_fcm_tokens, "RetriesExhausted")
+                return
+            await asyncio.sleep(self._get_retry_delay(attempt, retry_after))
+
+    def _get_retry_delay(self, attempt, retry_after):
+        if retry_after and retry_after.isdigit():
+            return min(int(retry_after), self.MAX_RETRY_AFTER_SEC)
+        return self.RETRY_BACKOFF_SEC * 2 ** (attempt - 1)
+
+    async def reset_application_fcm_dict(self):
+        application_server_key_dict = {}
         for (
             application,
             settings,
         ) in self.context.applications_service.get_applications_settings().items():
             firebase_server_key = settings.get("firebase_server_key", None)
             if firebase_server_key:
-                application_fcm_dict[application] = FCMNotification(
-                    api_key=firebase_server_key
-                )
+                application_server_key_dict[application] = firebase_server_key
+        await self.set_application_server_keys(application_server_key_dict)
 
-        self.application_fcm_dict.clear()
+    async def set_application_server_keys(self, application_server_key_dict):
+        """
+        Keeps the clients (and their connection pools) of applications whose server key did not change, and
+        rebuilds only the clients of new or changed applications.
+        """
+        old_application_fcm_dict = self.application_fcm_dict
+        application_fcm_dict = {}
+        for application, server_key in application_server_key_dict.items():
+            fcm = old_application_fcm_dict.get(application, None)
+            if fcm is None or fcm.server_key != server_key:
+                LOGGER.info(f"Creating fcm client for application {application}")
+                fcm = FcmApplicationClient(server_key)
+            application_fcm_dict[application] = fcm
         self.application_fcm_dict = application_fcm_dict
 
-    def get_copied_application_fcm_dict(self):
-        return self.application_fcm_dict.copy()
+        for application, fcm in old_application_fcm_dict.items():
+            if application_fcm_dict.get(application, None) is not fcm:
+                await fcm.close()
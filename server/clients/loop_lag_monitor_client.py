@@ -0,0 +1,47 @@
+import asyncio
+import logging
+import time
+
+LOGGER = logging.getLogger("Server.LoopLagMonitorClient")
+
+
+class LoopLagMonitorClient:
+    """
+    Measures how late the event loop wakes up a sleeping task. The lag is smoothed with an exponential moving
+    average, so a single slow callback does not trigger load shedding.
+    """
+
+    CHECK_SEC_INTERVAL = 0.1
+    SMOOTHING_FACTOR = 0.3
+
+    def __init__(self, context):
+        self.context = context
+        self.lag_ms = 0
+        self.max_lag_ms = 0
+
+    async def handle(self):
+        while True:
+            started_at = time.monotonic()
+            await asyncio.sleep(self.CHECK_SEC_INTERVAL)
+            lag_ms = max(
+                (time.monotonic() - started_at - self.CHECK_SEC_INTERVAL) * 1000, 0
+            )
+            self.lag_ms = (
+                self.SMOOTHING_FACTOR * lag_ms
+                + (1 - self.SMOOTHING_FACTOR) * self.lag_ms
+            )
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+
+    def get_lag_ms(self):
+        return self.lag_ms
+
+    def get_stats(self):
+        """
+        Returns the current lag and the maximum lag since the previous call.
+        """
+        stats = {
+            "lag_ms": round(self.lag_ms, 2),
+            "max_lag_ms": round(self.max_lag_ms, 2),
+        }
+        self.max_lag_ms = 0
+        return stats
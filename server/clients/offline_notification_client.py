@@ -1,65 +1,192 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import asyncio
 
 from server.clients.firebase_client import FirebaseClient
+from server.services.offline_notification_spool import OfflineNotificationSpool
 from server.settings.settings import FCM_NOTIFICATION_SEC_INTERVAL
 
 LOGGER = logging.getLogger("Server.OfflineNotificationClient")
 
 
+class OfflineChatRoomNotification:
+    """
+    All messages a single offline user missed in a single chat room during one interval, collapsed into one push.
+    """
+
+    def __init__(self, message):
+        self.last_message = message
+        self.messages_count = 1
+
+    def add_message(self, message):
+        self.last_message = message
+        self.messages_count += 1
+
+    def get_message(self):
+        message = dict(self.last_message)
+        message["messages_count"] = self.messages_count
+        if self.messages_count > 1:
+            message["message"] = f"{self.messages_count} new messages"
+        return message
+
+
 class OfflineNotificationClient:
+    """
+    Sends push notifications to offline users. If the context has an offline notification spool, notifications
+    are only appended to the spool and the OfflineNotificationWorker process sends them.
+    """
+
+    SPOOL_FLUSH_SEC_INTERVAL = 0.5
 
     def __init__(self, context):
         self.context = context
         self.application_identifier_offline_message_dict = (
             {}
-        )  # Device identifier -> message dict
+        )  # Application user identifier -> { Chat room identifier -> OfflineChatRoomNotification }
+        self.spool_buffer = (
+            []
+        )  # [(application user identifier, message)] waiting to be appended to the spool
+        # A single thread owns the spool's sqlite connection
+        self.spool_executor = ThreadPoolExecutor(max_workers=1)
         self.firebase_client = FirebaseClient(self.context)
+        self.last_flush_timings = {}
 
     async def handle(self):
+        if self.context.offline_notification_spool:
+            while True:
+                await self.flush_spool_buffer()
+                await asyncio.sleep(self.SPOOL_FLUSH_SEC_INTERVAL)
+
         while True:
-            LOGGER.info(
-                f"Sending notification to offline users: {self.application_identifier_offline_message_dict}"
+            try:
+                await self.flush()
+            except Exception as e:
+                LOGGER.exception(
+                    f"Exception while sending offline notifications: {str(e)}"
+                )
+            await asyncio.sleep(FCM_NOTIFICATION_SEC_INTERVAL)
+
+    async def flush_pending(self):
+        """
+        Sends (or appends to the spool) all offline notifications waiting for the next periodic flush.
+        """
+        try:
+            if self.context.offline_notification_spool:
+                await self.flush_spool_buffer()
+            else:
+                await self.flush()
+        except Exception as e:
+            LOGGER.exception(
+                f"Exception while flushing offline notifications: {str(e)}"
             )
-            offline_message_dict = (
-                self.application_identifier_offline_message_dict.copy()
+
+    async def flush(self):
+        offline_message_dict = self.application_identifier_offline_message_dict
+        self.application_identifier_offline_message_dict = {}
+        await self.send_notifications(offline_message_dict)
+
+    async def flush_spool_buffer(self):
+        spool_buffer = self.spool_buffer
+        self.spool_buffer = []
+        if not spool_buffer:
+            return
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                self.spool_executor,
+                self.context.offline_notification_spool.append,
+                spool_buffer,
+            )
+        except Exception as e:
+            LOGGER.exception(
+                f"Exception while appending offline notifications to the spool: {str(e)}"
             )
-            self.application_identifier_offline_message_dict.clear()
+            self.spool_buffer = spool_buffer + self.spool_buffer
 
-            device_message_dict = {}
-            for application_user_identifier, message in offline_message_dict.items():
-                (device_fcm_tokens, application_identifier) = (
-                    await self.context.device_identifier_cache_service.get_user_identifier_fcm_tokens(
-                        application_user_identifier
-                    )
-                )
-                LOGGER.debug(
-                    f"Fetched device fcm tokens for user: {application_user_identifier}: {device_fcm_tokens}"
-                )
+    async def send_notifications(self, offline_message_dict):
+        LOGGER.info(
+            f"Sending notification to {len(offline_message_dict)} offline users"
+        )
+        if not offline_message_dict:
+            return
+
+        start = time.monotonic()
+        users_fcm_tokens_dict = await self.context.device_identifier_cache_service.get_users_identifier_fcm_tokens(
+            offline_message_dict.keys()
+        )
+        token_resolution_end = time.monotonic()
+
+        # [(device fcm token, message, application identifier)]
+        device_message_list = []
+        for (
+            application_user_identifier,
+            chat_room_notifications,
+        ) in offline_message_dict.items():
+            device_fcm_tokens, application_identifier = users_fcm_tokens_dict.get(
+                application_user_identifier, ([], None)
+            )
+            for chat_room_notification in chat_room_notifications.values():
+                message = chat_room_notification.get_message()
                 for device_fcm_token in device_fcm_tokens:
-                    if device_fcm_token:
-                        device_message_dict[device_fcm_token] = (
-                            message,
-                            application_identifier,
-                        )
-
-            application_fcm_dict = (
-                self.firebase_client.get_copied_application_fcm_dict()
+                    device_message_list.append(
+                        (device_fcm_token, message, application_identifier)
+                    )
+        aggregation_end = time.monotonic()
+
+        send_result = await self.firebase_client.send_fcm_notifications(
+            device_message_list
+        )
+        send_end = time.monotonic()
+        self.context.device_identifier_cache_service.handle_fcm_send_result(send_result)
+
+        self.last_flush_timings = {
+            "users_count": len(offline_message_dict),
+            "notifications_count": len(device_message_list),
+            "success_count": send_result.success_count,
+            "failure_count": send_result.failure_count,
+            "token_resolution_sec": token_resolution_end - start,
+            "aggregation_sec": aggregation_end - token_resolution_end,
+            "send_sec": send_end - aggregation_end,
+        }
+        LOGGER.info(f"Offline notifications flush timings: {self.last_flush_timings}")
+
+    def set_offline_application_user(self, application_user_identifier, message):
+        if self.context.offline_notification_spool:
+            self.spool_buffer.append((application_user_identifier, message))
+        else:
+            self.add_offline_notification(
+                self.application_identifier_offline_message_dict,
+                application_user_identifier,
+                message,
             )
-            await asyncio.get_event_loop().run_in_executor(
-                None,
-                self.execute_send_notification,
-                application_fcm_dict,
-                device_message_dict,
+
+    def invalidate_fcm_tokens(self, application_user_identifier):
+        if self.context.offline_notification_spool:
+            # Tokens are cached by the OfflineNotificationWorker, a message of None invalidates them there
+            self.spool_buffer.append((application_user_identifier, None))
+        else:
+            self.context.device_identifier_cache_service.invalidate(
+                application_user_identifier
             )
-            await asyncio.sleep(FCM_NOTIFICATION_SEC_INTERVAL)
 
-    def set_offline_application_user(self, application_user_identifier, message):
-        self.application_identifier_offline_message_dict[
-            application_user_identifier
-        ] = message
+    def invalidate_all_fcm_tokens(self):
+        if self.context.offline_notification_spool:
+            self.spool_buffer.append((OfflineNotificationSpool.ALL_APP_USERS, None))
+        else:
+            self.context.device_identifier_cache_service.invalidate_all()
 
     @staticmethod
-    def execute_send_notification(application_fcm_dict, device_message_dict):
-        FirebaseClient.send_fcm_notifications(application_fcm_dict, device_message_dict)
+    def add_offline_notification(
+        offline_message_dict, application_user_identifier, message
+    ):
+        chat_room_notifications = offline_message_dict.setdefault(
+            application_user_identifier, {}
+        )
+        chat_room_identifier = message["chat_room_identifier"]
+        if chat_room_identifier in chat_room_notifications:
+            chat_room_notifications[chat_room_identifier].add_message(message)
+        else:
+            chat_room_notifications[chat_room_identifier] = OfflineChatRoomNotification(
+                message
+            )
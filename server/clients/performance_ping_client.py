@@ -1,14 +1,7 @@
 import asyncio
 import logging
 
-import aiohttp
-
-from server.settings.settings import (
-    CHAT_API_INTERNAL_SECRET,
-    CHAT_PERMISSION_HEADER,
-)
-from server.utils.utils import make_server_call, prepare_server_url
-
+from server.clients.chat_api_client import ChatApiException
 
 LOGGER = logging.getLogger("Server.StatusPingClient")
 
@@ -22,20 +15,22 @@ class PerformancePingClient:
         while True:
             await asyncio.sleep(5 * 60)
             LOGGER.debug("Sending performance message to django api.")
-            headers = {CHAT_PERMISSION_HEADER: CHAT_API_INTERNAL_SECRET}
-            async with aiohttp.ClientSession(headers=headers) as session:
-                url = prepare_server_url("chat-server-status/report-performance/")
-                performance_data = (
-                    self.context.dynamodb_performance_service.get_performance_data()
+            performance_data = (
+                self.context.dynamodb_performance_service.get_performance_data()
+            )
+            data = {
+                "identifier": str(self.context.websocket_server_identifier),
+                "timestamp_from": performance_data.from_datetime.strftime(
+                    "%Y-%m-%dT%H:%M:%S.%fZ"
+                ),
+                "timestamp_to": performance_data.to_datetime.strftime(
+                    "%Y-%m-%dT%H:%M:%S.%fZ"
+                ),
+                "performance_data": performance_data.data,
+            }
+            try:
+                await self.context.chat_api_client.post(
+                    "chat-server-status/report-performance/", json=data
                 )
-                data = {
-                    "identifier": str(self.context.websocket_server_identifier),
-                    "timestamp_from": performance_data.from_datetime.strftime(
-                        "%Y-%m-%dT%H:%M:%S.%fZ"
-                    ),
-                    "timestamp_to": performance_data.to_datetime.strftime(
-                        "%Y-%m-%dT%H:%M:%S.%fZ"
-                    ),
-                    "performance_data": performance_data.data,
-                }
-                await make_server_call(session, url, method="post", json=data)
+            except ChatApiException as e:
+                LOGGER.warning(f"Cannot report dynamodb performance data: {str(e)}")
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+
+from websockets.exceptions import WebSocketException
+
+from server.services.presence_digest import PresenceDigest
+from server.utils.utils import MessageType
+
+LOGGER = logging.getLogger("Server.PresenceDigestClient")
+
+
+class PresenceDigestClient:
+    """
+    Anti-entropy of the app users registered at the central routers. A lost ADD or REMOVE message would make the
+    central routers route to the wrong chat servers until the next FULL_SYNC, so the digest of the registered app
+    users is sent every DIGEST_SEC_INTERVAL. A central router with a different digest answers with the mismatched
+    buckets, and only the app users of those buckets are sent to it again.
+    """
+
+    DIGEST_SEC_INTERVAL = 60
+
+    def __init__(self, context):
+        self.context = context
+        # App users registered at the central routers, see ReplayBufferService
+        self.presence_digest = PresenceDigest()
+        self.repaired_buckets_count = 0
+
+    def toggle(self, application_user_identifier):
+        self.presence_digest.toggle(application_user_identifier)
+
+    async def handle(self):
+        while True:
+            await asyncio.sleep(self.DIGEST_SEC_INTERVAL)
+            # A draining server has already removed all of its users from the central routers
+            if self.context.drain_service.is_draining():
+                continue
+            try:
+                await self.context.central_router_client.send_message_to_all_routers(
+                    {
+                        "type": MessageType.PRESENCE_DIGEST,
+                        "buckets": self.presence_digest.buckets,
+                    }
+                )
+            except WebSocketException as e:
+                LOGGER.warning(f"Cannot send presence digest: {str(e)}")
+
+    def get_bucket_users(self, bucket_indexes):
+        bucket_indexes = set(bucket_indexes)
+        return [
+            application_user_identifier
+            for application_user_identifier in self.context.replay_buffer_service.get_application_user_identifiers()
+            if PresenceDigest.get_bucket_index(application_user_identifier)
+            in bucket_indexes
+        ]
+
+    def get_stats(self):
+        stats = {"repaired_buckets_count": self.repaired_buckets_count}
+        self.repaired_buckets_count = 0
+        return stats
@@ -1,13 +1,7 @@
 import asyncio
 import logging
 
-import aiohttp
-
-from server.settings.settings import (
-    CHAT_API_INTERNAL_SECRET,
-    CHAT_PERMISSION_HEADER,
-)
-from server.utils.utils import make_server_call, prepare_server_url
+from server.clients.chat_api_client import ChatApiException
 
 LOGGER = logging.getLogger("Server.StatusPingClient")
 
@@ -20,15 +14,15 @@ class StatusPingClient:
     async def handle(self):
         while True:
             LOGGER.debug("Sending ping message to django api.")
-            headers = {CHAT_PERMISSION_HEADER: CHAT_API_INTERNAL_SECRET}
-            async with aiohttp.ClientSession(headers=headers) as session:
-                url = prepare_server_url("chat-server-status/report-status/")
-                data = {
-                    "identifier": str(self.context.websocket_server_identifier),
-                    "connected_clients_count": len(
-                        self.context.application_user_device_dict
-                    ),
-                    "application_data": self.context.applications_service.get_applications_dict(),
-                }
-                await make_server_call(session, url, method="post", json=data)
+            data = {
+                "identifier": str(self.context.websocket_server_identifier),
+                "connected_clients_count": self.context.connection_registry.get_users_count(),
+                "application_data": self.context.connection_registry.get_application_connections_count_dict(),
+            }
+            try:
+                await self.context.chat_api_client.post(
+                    "chat-server-status/report-status/", json=data
+                )
+            except ChatApiException as e:
+                LOGGER.warning(f"Cannot report chat server status: {str(e)}")
             await asyncio.sleep(5 * 60)
@@ -0,0 +1,46 @@
+import asyncio
+import logging
+import os
+import queue
+
+LOGGER = logging.getLogger("Server.WorkerStatsClient")
+
+
+class WorkerStatsClient:
+    """
+    Periodically publishes stats of a single chat server worker to the ChatServerSupervisor, which aggregates
+    them across all worker processes.
+    """
+
+    STATS_SEC_INTERVAL = 10
+
+    def __init__(self, context, worker_stats_queue):
+        self.context = context
+        self.worker_stats_queue = worker_stats_queue
+
+    async def handle(self):
+        while True:
+            try:
+                self.worker_stats_queue.put_nowait(self.get_worker_stats())
+            except queue.Full:
+                LOGGER.warning("Worker stats queue is full. Skipping stats update.")
+            except Exception as e:
+                LOGGER.error(f"Exception while publishing worker stats: {str(e)}")
+            await asyncio.sleep(self.STATS_SEC_INTERVAL)
+
+    def get_worker_stats(self):
+        return {
+            "pid": os.getpid(),
+            "identifier": str(self.context.websocket_server_identifier),
+            "connected_clients_count": self.context.connection_registry.get_users_count(),
+            "connections_count": self.context.connection_registry.get_connections_count(),
+            "application_data": self.context.connection_registry.get_application_connections_count_dict().copy(),
+            "handshake_stats": self.context.handshake_admission_service.get_stats(),
+            "application_queue_stats": self.context.fair_scheduler_service.get_stats(),
+            "loop_lag_stats": self.context.loop_lag_monitor_client.get_stats(),
+            "memory_stats": self.context.websocket_memory_profile_service.get_stats(),
+            "compression_stats": self.context.compression_service.get_stats(),
+            "json_encoding_stats": self.context.json_encoding_service.get_stats(),
+            "replay_stats": self.context.replay_buffer_service.get_stats(),
+            "presence_digest_stats": self.context.presence_digest_client.get_stats(),
+        }
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from server.clients.application_settings_client import (
+    ApplicationSettingsClient,
+)
+from server.clients.chat_api_client import ChatApiClient
+from server.clients.offline_notification_client import (
+    OfflineNotificationClient,
+)
+from server.services.applications_service import ApplicationService
+from server.services.cache_service import DeviceFcmTokenCacheService
+from server.services.dynamodb_performance_service import (
+    DynamodbPerformanceService,
+)
+from server.services.dynamodb_service import DynamodbService
+from server.services.email_exception_service import EmailExceptionService
+from server.services.offline_notification_spool import OfflineNotificationSpool
+from server.settings.settings import (
+    DYNAMO_SESSION_TABLE_NAME,
+    DYNAMO_CHAT_ROOM_TABLE_NAME,
+    DYNAMO_CHAT_MESSAGE_TABLE_NAME,
+    DYNAMO_LAST_MESSAGE_READ_TABLE_NAME,
+    DYNAMO_USER_IDENTIFIER_CUSTOM_DATA_TABLE_NAME,
+    FCM_NOTIFICATION_SEC_INTERVAL,
+)
+
+LOGGER = logging.getLogger("Server.OfflineNotificationWorker")
+
+
+class OfflineNotificationWorkerContext:
+    """
+    The part of the chat server Context needed to send offline notifications.
+    """
+
+    def __init__(self, offline_notification_spool_path):
+        self.websocket_server_identifier = uuid.uuid4()
+        self.email_exception_service = EmailExceptionService(self)
+        self.offline_notification_spool = OfflineNotificationSpool(
+            offline_notification_spool_path
+        )
+
+        # Clients
+        self.chat_api_client = ChatApiClient(self)
+        self.offline_notification_client = OfflineNotificationClient(self)
+        self.application_settings_client = ApplicationSettingsClient(self)
+
+        # Services
+        self.device_identifier_cache_service = DeviceFcmTokenCacheService(self)
+        self.applications_service = ApplicationService(self)
+
+        # Dynamodb
+        self.dynamodb_service = DynamodbService(
+            self,
+            DYNAMO_SESSION_TABLE_NAME,
+            DYNAMO_CHAT_ROOM_TABLE_NAME,
+            DYNAMO_CHAT_MESSAGE_TABLE_NAME,
+            DYNAMO_LAST_MESSAGE_READ_TABLE_NAME,
+            DYNAMO_USER_IDENTIFIER_CUSTOM_DATA_TABLE_NAME,
+        )
+        self.dynamodb_performance_service = DynamodbPerformanceService(self)
+
+
+class OfflineNotificationWorker:
+    """
+    Consumes the offline notification spool written by the chat server workers and sends the notifications, so
+    FCM latency never touches the websocket event loops. The checkpoint is moved after a batch was handed to FCM,
+    so notifications rejected by FCM are not sent again. A batch whose sending raises is retried up to
+    MAX_BATCH_ATTEMPTS times and then skipped, and malformed rows are skipped, so the spool cannot get stuck.
+    """
+
+    CONSUMER = "offline_notification_worker"
+    BATCH_SIZE = 10000
+    MAX_BATCH_ATTEMPTS = 3
+
+    def __init__(self, offline_notification_spool_path):
+        self.context = OfflineNotificationWorkerContext(offline_notification_spool_path)
+        # A single thread owns the spool's sqlite connection
+        self.spool_executor = ThreadPoolExecutor(max_workers=1)
+        self.failed_batch_attempts_count = 0
+
+    async def serve(self):
+        await self.context.dynamodb_service.connect()
+        application_settings_task = asyncio.create_task(
+            self.context.application_settings_client.handle()
+        )
+        consume_spool_task = asyncio.create_task(self.consume_spool())
+        await asyncio.gather(application_settings_task, consume_spool_task)
+
+    async def consume_spool(self):
+        # Without application settings there are no FCM server keys to send the notifications with
+        while not self.context.applications_service.get_applications_settings():
+            await asyncio.sleep(1)
+
+        while True:
+            offline_notifications = []
+            try:
+                last_id, offline_notifications = await self._run_in_spool_executor(
+                    self.context.offline_notification_spool.read_batch,
+                    self.CONSUMER,
+                    self.BATCH_SIZE,
+                )
+                if last_id is not None:
+                    try:
+                        await self.send_offline_notifications(offline_notifications)
+                    except Exception as e:
+                        self.failed_batch_attempts_count += 1
+                        if self.failed_batch_attempts_count < self.MAX_BATCH_ATTEMPTS:
+                            raise
+                        LOGGER.exception(
+                            f"Skipping {len(offline_notifications)} offline notifications up to id {last_id} "
+                            f"after {self.failed_batch_attempts_count} failed attempts: {str(e)}"
+                        )
+                    self.failed_batch_attempts_count = 0
+                    await self._run_in_spool_executor(
+                        self.context.offline_notification_spool.commit_checkpoint,
+                        self.CONSUMER,
+                        last_id,
+                    )
+            except Exception as e:
+                LOGGER.exception(
+                    f"Exception while consuming offline notification spool: {str(e)}"
+                )
+
+            # A full batch means that the spool is behind, so keep consuming without waiting
+            if len(offline_notifications) < self.BATCH_SIZE:
+                await asyncio.sleep(FCM_NOTIFICATION_SEC_INTERVAL)
+
+    async def send_offline_notifications(self, offline_notifications):
+        offline_message_dict = {}
+        for application_user_identifier, message in offline_notifications:
+            if message is None:
+                if (
+                    application_user_identifier
+                    == OfflineNotificationSpool.ALL_APP_USERS
+                ):
+                    self.context.device_identifier_cache_service.invalidate_all()
+                else:
+                    self.context.device_identifier_cache_service.invalidate(
+                        application_user_identifier
+                    )
+                continue
+            try:
+                OfflineNotificationClient.add_offline_notification(
+                    offline_message_dict, application_user_identifier, message
+                )
+            except (KeyError, TypeError, AttributeError) as e:
+                LOGGER.error(
+                    f"Skipping malformed offline notification of user {application_user_identifier}: {str(e)}"
+                )
+        await self.context.offline_notification_client.send_notifications(
+            offline_message_dict
+        )
+
+    async def _run_in_spool_executor(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(
+            self.spool_executor, func, *args
+        )
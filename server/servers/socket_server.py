@@ -1,5 +1,7 @@
 import asyncio
 import logging
+import signal
+import time
 import traceback
 import uuid
 from http import HTTPStatus
@@ -12,14 +14,19 @@ from server.clients.application_settings_client import (
     ApplicationSettingsClient,
 )
 from server.clients.central_router_client import DnsClient
+from server.clients.chat_api_client import ChatApiClient
+from server.clients.loop_lag_monitor_client import LoopLagMonitorClient
 from server.clients.offline_notification_client import (
     OfflineNotificationClient,
 )
 from server.clients.performance_ping_client import PerformancePingClient
+from server.clients.presence_digest_client import PresenceDigestClient
 from server.clients.status_ping_client import StatusPingClient
+from server.clients.worker_stats_client import WorkerStatsClient
 from server.services.anti_spam_service import AntiSpamMixin
 from server.services.applications_service import ApplicationService
 from server.services.cache_service import (
+    ChatRoomCacheService,
     CustomDataCacheService,
     DeviceFcmTokenCacheService,
 )
@@ -29,12 +36,26 @@ from server.services.central_router_message_service import (
 from server.services.dynamodb_performance_service import (
     DynamodbPerformanceService,
 )
+from server.services.compression_service import CompressionService
+from server.services.connection_registry import ConnectionRegistry
+from server.services.drain_service import DrainService
 from server.services.dynamodb_service import DynamodbService
 from server.services.email_exception_service import EmailExceptionService
+from server.services.fair_scheduler_service import FairSchedulerService
+from server.services.handshake_admission_service import (
+    HandshakeAdmissionService,
+)
+from server.services.json_encoding_service import JsonEncodingService
 from server.services.manager_message_handler_service import (
     ManagerMessageHandlerService,
 )
+from server.services.offline_notification_spool import OfflineNotificationSpool
+from server.services.replay_buffer_service import ReplayBufferService
+from server.services.request_pipeline_service import RequestPipelineMixin
 from server.services.socket_service import SocketService
+from server.services.websocket_memory_profile_service import (
+    WebsocketMemoryProfileService,
+)
 from server.services.websocket_message_handler_service import (
     WebSocketMessageHandlerService,
 )
@@ -51,37 +72,57 @@ from server.utils.exceptions import (
     ChatServerException,
     DnsConnectionsException,
     MessageSpamException,
+    MessageRateLimitedException,
 )
-from server.utils.utils import send_error
+from server.utils.utils import MessageType, send_error
 
 LOGGER = logging.getLogger("Server.SocketServer")
 
 
 class Context:
 
-    def __init__(self):
+    def __init__(self, worker_stats_queue=None, offline_notification_spool_path=None):
 
-        # Application User Identifier -> { Device Identifier -> websocket}
-        # A two-level dict, mapping app user identifier to a dict, where keys are Device Identifiers and values are
-        # websockets. Allows to find a websocket for given user identifier and device identifier.
-        self.application_user_device_dict = {}
+        # All websocket connections, indexed by application and by app user
+        self.connection_registry = ConnectionRegistry(self)
         self.websocket_server_identifier = uuid.uuid4()
         self.email_exception_service = EmailExceptionService(self)
+        # When set, offline notifications are sent by a separate OfflineNotificationWorker process
+        self.offline_notification_spool = (
+            OfflineNotificationSpool(offline_notification_spool_path)
+            if offline_notification_spool_path
+            else None
+        )
 
         # Clients
+        self.chat_api_client = ChatApiClient(self)
         self.status_ping_client = StatusPingClient(self)
         self.offline_notification_client = OfflineNotificationClient(self)
         self.central_router_client = DnsClient(self)
         self.application_settings_client = ApplicationSettingsClient(self)
         self.performance_ping_client = PerformancePingClient(self)
+        self.loop_lag_monitor_client = LoopLagMonitorClient(self)
+        self.presence_digest_client = PresenceDigestClient(self)
+        # Only set when the server runs as a worker of the ChatServerSupervisor
+        self.worker_stats_client = (
+            WorkerStatsClient(self, worker_stats_queue) if worker_stats_queue else None
+        )
 
         # Services
         self.central_router_message_service = DnsMessageService(self)
         self.websocket_message_service = WebSocketMessageHandlerService(self)
         self.custom_data_cache_service = CustomDataCacheService(self)
+        self.chat_room_cache_service = ChatRoomCacheService(self)
         self.device_identifier_cache_service = DeviceFcmTokenCacheService(self)
         self.socket_service = SocketService(self)
         self.applications_service = ApplicationService(self)
+        self.handshake_admission_service = HandshakeAdmissionService(self)
+        self.fair_scheduler_service = FairSchedulerService(self)
+        self.drain_service = DrainService(self)
+        self.websocket_memory_profile_service = WebsocketMemoryProfileService(self)
+        self.compression_service = CompressionService(self)
+        self.json_encoding_service = JsonEncodingService(self)
+        self.replay_buffer_service = ReplayBufferService(self)
 
         self.manager_message_service = ManagerMessageHandlerService(self)
 
@@ -98,11 +139,12 @@ class Context:
 
 
 class ChatServer:
+    ORDERED_MESSAGE_TYPES = {MessageType.ROUTABLE, MessageType.SET_LAST_MESSAGE_READ}
 
-    def __init__(self):
-        self.context = Context()
+    def __init__(self, worker_stats_queue=None, offline_notification_spool_path=None):
+        self.context = Context(worker_stats_queue, offline_notification_spool_path)
 
-    async def serve(self, host, port):
+    async def serve(self, host, port, reuse_port=False):
         await self.context.dynamodb_service.connect()
         central_router_task = asyncio.create_task(
             self.context.central_router_client.handle()
@@ -117,24 +159,57 @@ class ChatServer:
         performance_ping_task = asyncio.create_task(
             self.context.performance_ping_client.handle()
         )
+        loop_lag_monitor_task = asyncio.create_task(
+            self.context.loop_lag_monitor_client.handle()
+        )
+        websocket_memory_profile_task = asyncio.create_task(
+            self.context.websocket_memory_profile_service.handle()
+        )
+        presence_digest_task = asyncio.create_task(
+            self.context.presence_digest_client.handle()
+        )
 
-        socket_server_task = asyncio.create_task(self.server_task(host, port))
-        await asyncio.gather(
+        socket_server_task = asyncio.create_task(
+            self.server_task(host, port, reuse_port)
+        )
+        tasks = [
             central_router_task,
             socket_server_task,
             status_ping_task,
             offline_notification_task,
             application_settings_task,
             performance_ping_task,
+            loop_lag_monitor_task,
+            websocket_memory_profile_task,
+            presence_digest_task,
+        ]
+        if self.context.worker_stats_client:
+            tasks.append(asyncio.create_task(self.context.worker_stats_client.handle()))
+
+        # SIGTERM (e.g. from the ChatServerSupervisor or a deploy) drains the server before it exits
+        asyncio.get_event_loop().add_signal_handler(
+            signal.SIGTERM, self.context.drain_service.request_drain
+        )
+        drained_task = asyncio.create_task(self.context.drain_service.wait_drained())
+        await asyncio.wait(
+            [asyncio.gather(*tasks), drained_task],
+            return_when=asyncio.FIRST_COMPLETED,
         )
+        for task in tasks + [drained_task]:
+            task.cancel()
+        await self.context.chat_api_client.close()
 
-    async def server_task(self, host, port):
+    async def server_task(self, host, port, reuse_port=False):
         try:
+            # With reuse_port=True several worker processes bind the same port and the kernel
+            # balances incoming connections between them (SO_REUSEPORT)
             async with serve(
                 self.messages_loop,
                 host,
                 port,
                 create_protocol=ChatServerProtocol,
+                reuse_port=reuse_port,
+                **self.context.websocket_memory_profile_service.get_serve_kwargs(),
             ) as ws_server:
                 self.server_socket = ws_server
                 ws_server.context = self.context
@@ -146,38 +221,60 @@ class ChatServer:
 
     async def messages_loop(self, websocket: "ChatServerProtocol", path):
         message = None
+        try:
+            await self.context.replay_buffer_service.replay(websocket)
+        except WebSocketException:
+            return
         while True:
+            message_dict = None
             try:
 
                 message = await websocket.recv()
-                websocket.check_anti_spam()
-
-                if not websocket.is_manager:
-                    if (
-                        not self.context.central_router_client.is_central_router_available()
-                    ):
-                        exception = DnsConnectionsException()
-                        await self.context.email_exception_service.notify_admin(
-                            exception, None
-                        )
-                        raise exception
+                self.context.websocket_memory_profile_service.mark_active(websocket)
+                try:
                     message_dict = json.loads(message)
-                    await self.context.websocket_message_service.handle_message(
-                        message_dict, websocket
-                    )
-                else:
-                    message_dict = json.loads(message)
-                    await self.context.manager_message_service.handle_message(
-                        message_dict, websocket
+                except JSONDecodeError:
+                    # Invalid messages are charged too
+                    websocket.check_anti_spam()
+                    raise
+                if not isinstance(message_dict, dict):
+                    websocket.check_anti_spam()
+                    raise InvalidMessageFormat()
+                message_type = message_dict.get("type", None)
+                if not websocket.check_anti_spam(message_type):
+                    continue
+
+                if message_dict.get("request_id", None) is None:
+                    # Responses cannot be matched without a request id, so the message is handled in order
+                    await websocket.run_in_order(
+                        self.handle_message, websocket, message_dict, message
                     )
+                    continue
+                # Messages are handled concurrently, only chat messages and last message read updates of the same
+                # chat room have to keep their order
+                ordering_key = (
+                    message_dict.get("chat_room_identifier", None)
+                    if message_type in self.ORDERED_MESSAGE_TYPES
+                    else None
+                )
+                await websocket.pipeline(
+                    ordering_key, self.handle_message, websocket, message_dict, message
+                )
 
             except MessageSpamException as e:
                 await send_error(e, websocket)
                 return
-            except CustomException as e:
-                LOGGER.warning(f"Custom exception: {e.get_message()}")
-                await send_error(e, websocket)
-            except JSONDecodeError:
+            except MessageRateLimitedException as e:
+                await send_error(
+                    e,
+                    websocket,
+                    (
+                        message_dict.get("request_id", None)
+                        if isinstance(message_dict, dict)
+                        else None
+                    ),
+                )
+            except (JSONDecodeError, InvalidMessageFormat):
                 LOGGER.exception(
                     f"Invalid message format: Must be a dictionary with proper fields: {message}."
                 )
@@ -202,12 +299,69 @@ class ChatServer:
                 return
             # IMPORTANT. This method cannot raise an exception, cause on_close method on protocol will not be called.
 
+    async def handle_message(
+        self, websocket: "ChatServerProtocol", message_dict, message
+    ):
+        # Responses and errors carry the request id supplied by the client, so pipelined requests can be matched
+        request_id = message_dict.get("request_id", None)
+        try:
+            if not websocket.is_manager:
+                if not self.context.central_router_client.is_central_router_available():
+                    exception = DnsConnectionsException()
+                    await self.context.email_exception_service.notify_admin(
+                        exception, None
+                    )
+                    raise exception
+                await self.context.fair_scheduler_service.run(
+                    websocket.application_identifier,
+                    self.context.websocket_message_service.handle_message,
+                    message_dict,
+                    websocket,
+                )
+            else:
+                await self.context.fair_scheduler_service.run(
+                    websocket.application_identifier,
+                    self.context.manager_message_service.handle_message,
+                    message_dict,
+                    websocket,
+                )
+
+        except CustomException as e:
+            LOGGER.warning(f"Custom exception: {e.get_message()}")
+            await send_error(e, websocket, request_id)
+        except WebSocketException as e:
+            # The client has disconnected, messages_loop handles the closed connection
+            LOGGER.warning(
+                f"WebSocketException exception in handle_message method: {str(e)}."
+            )
+        except Exception as e:
+            LOGGER.exception(
+                f"{e.__class__.__name__} exception in handle_message method: {str(e)}."
+            )
+            stack_trace = traceback.format_exc()
+            await self.context.email_exception_service.notify_admin(
+                e, stack_trace, message
+            )
+            try:
+                await send_error(
+                    ChatServerException(e.__class__.__name__, e), websocket, request_id
+                )
+                # Close code 1011: Internal Error
+                await websocket.close(1011)
+            except WebSocketException:
+                pass
 
-class ChatServerProtocol(ServerProtocol, AntiSpamMixin):
+
+class ChatServerProtocol(ServerProtocol, AntiSpamMixin, RequestPipelineMixin):
 
     async def process_request(self, path, request_headers):
         LOGGER.info(f"Received message from path: {path}")
         self.connection_closed = False
+        self.application_user_identifier = None
+        self.device_identifier = None
+        self.resume_message_identifier = (
+            self.context.socket_service.get_resume_message_identifier(path)
+        )
 
         token, error_response = self.context.socket_service.validate_token(
             path, request_headers
@@ -215,31 +369,66 @@ class ChatServerProtocol(ServerProtocol, AntiSpamMixin):
         if error_response and not token:
             return error_response
 
+        # Admission is checked before the session lookup, so an overloaded server does not even query DynamoDB
+        error_response = self.context.handshake_admission_service.admit()
+        if error_response:
+            return error_response
+        try:
+            return await self.process_admitted_request(token, request_headers)
+        finally:
+            self.context.handshake_admission_service.release()
+
+    async def process_admitted_request(self, token, request_headers):
         session, error_response = await self.context.socket_service.validate_session(
             token
         )
         if error_response and not session:
             return error_response
         self.application_identifier = token.split(":")[-1]
+        error_response = self.context.handshake_admission_service.admit_application(
+            self.application_identifier
+        )
+        if error_response:
+            return error_response
 
         self.is_manager = await self.context.socket_service.validate_manager_header(
             request_headers
         )
-        self.init_counter()
+        self.init_rate_limiter(
+            self.context.applications_service.get_applications_settings().get(
+                self.application_identifier, None
+            )
+        )
+        self.init_pipeline()
+        if not self.is_manager:
+            self.application_user_identifier = session.application_user_identifier
+            self.device_identifier = session.device_identifier
 
-        can_be_connected = self.context.applications_service.increase_user_count(
-            self.application_identifier
+        self.memory_profile = (
+            self.context.websocket_memory_profile_service.get_application_profile(
+                self.application_identifier
+            )
         )
-        if not can_be_connected:
+        self.context.websocket_memory_profile_service.apply_profile(
+            self, self.memory_profile
+        )
+        self.is_idle = False
+        self.last_message_at = time.monotonic()
+
+        # No await between the check and the registration, so concurrent handshakes cannot exceed the limit
+        if not self.context.applications_service.can_connect(
+            self.application_identifier
+        ):
             message = "Connection refused: exceeded max concurrent online users limit for the application."
             return HTTPStatus.BAD_REQUEST, [], message
+        await self.context.socket_service.register_websocket_connection(self)
 
-        if not self.is_manager:
-            (self.application_user_identifier, self.device_identifier) = (
-                await self.context.socket_service.manage_user_websocket_connection(
-                    session, self
-                )
-            )
+    def process_extensions(self, headers, available_extensions):
+        # Called after process_request, so compression follows the memory profile of the application
+        return super().process_extensions(
+            headers,
+            self.context.compression_service.get_client_extensions(self.memory_profile),
+        )
 
     async def wait_closed(self):
         await self.close_websocket_connection()
@@ -252,10 +441,7 @@ class ChatServerProtocol(ServerProtocol, AntiSpamMixin):
     async def close_websocket_connection(self):
         if not self.connection_closed:
             LOGGER.info(f"Closing session for device {self.device_identifier}")
-            self.context.applications_service.reduce_user_count(
-                self.application_identifier
-            )
-            await self.context.socket_service.close_user_websocket_connection(self)
+            await self.context.socket_service.close_websocket_connection(self)
             self.connection_closed = True
 
     @property
@@ -0,0 +1,252 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+
+from server.servers.offline_notification_worker import OfflineNotificationWorker
+from server.servers.socket_server import ChatServer
+from server.services.drain_service import DrainService
+
+LOGGER = logging.getLogger("Server.Supervisor")
+
+
+def run_chat_server_worker(
+    host, port, worker_stats_queue, offline_notification_spool_path, is_resume_enabled
+):
+    # Every worker builds its own ChatServer (and Context) after the fork, so each worker gets its own
+    # websocket_server_identifier, central router connections and dynamodb client.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    chat_server = ChatServer(worker_stats_queue, offline_notification_spool_path)
+    if not is_resume_enabled:
+        chat_server.context.replay_buffer_service.disable_resume()
+    asyncio.run(chat_server.serve(host, port, reuse_port=True))
+    if chat_server.context.drain_service.is_draining():
+        sys.exit(DrainService.EXIT_CODE)
+
+
+def run_offline_notification_worker(offline_notification_spool_path):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    offline_notification_worker = OfflineNotificationWorker(
+        offline_notification_spool_path
+    )
+    asyncio.run(offline_notification_worker.serve())
+
+
+class WorkerProcess:
+
+    def __init__(self, worker_index, process, target, args):
+        self.worker_index = worker_index
+        self.process = process
+        self.target = target
+        self.args = args
+        self.started_at = time.monotonic()
+        self.restart_delay_sec = 0
+        self.restart_at = (
+            None  # Set when the worker has crashed and waits for a restart
+        )
+
+    def is_alive(self):
+        return self.restart_at is None and self.process.is_alive()
+
+
+class ChatServerSupervisor:
+    """
+    Forks a number of chat server workers sharing the same listening port (SO_REUSEPORT), restarts the ones that
+    crashed or were drained and aggregates their stats. Workers are independent processes, so a crash of one of them drops only
+    the clients connected to that worker. If offline_notification_spool_path is given, workers append offline
+    notifications to the spool and a separate OfflineNotificationWorker process sends them.
+    """
+
+    OFFLINE_NOTIFICATION_WORKER_INDEX = "offline_notification"
+
+    SUPERVISOR_SEC_INTERVAL = 1
+    STATS_SEC_INTERVAL = 60
+    MIN_WORKER_UPTIME_SEC = 10
+    MAX_RESTART_DELAY_SEC = 30
+    # Workers drain their clients (DrainService.DRAIN_WINDOW_SEC) before they stop
+    WORKER_STOP_TIMEOUT_SEC = 45
+
+    def __init__(
+        self,
+        host,
+        port,
+        workers_count=None,
+        stats_file_path=None,
+        offline_notification_spool_path=None,
+    ):
+        self.host = host
+        self.port = port
+        self.workers_count = workers_count or os.cpu_count() or 1
+        self.stats_file_path = stats_file_path
+        self.offline_notification_spool_path = offline_notification_spool_path
+
+        self.multiprocessing_context = multiprocessing.get_context("fork")
+        self.worker_stats_queue = self.multiprocessing_context.Queue()
+        self.workers = {}  # Worker index -> WorkerProcess
+        self.worker_stats_dict = {}  # Worker pid -> last stats reported by the worker
+        self.stopping = False
+        self.last_stats_export = time.monotonic()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        LOGGER.info(
+            f"Starting {self.workers_count} chat server workers on {self.host}:{self.port}"
+        )
+        for worker_index in range(self.workers_count):
+            self._start_worker(
+                worker_index,
+                run_chat_server_worker,
+                (
+                    self.host,
+                    self.port,
+                    self.worker_stats_queue,
+                    self.offline_notification_spool_path,
+                    # Buffers are kept by the worker, a reconnect reaches any worker sharing the port
+                    self.workers_count == 1,
+                ),
+            )
+        if self.offline_notification_spool_path:
+            self._start_worker(
+                self.OFFLINE_NOTIFICATION_WORKER_INDEX,
+                run_offline_notification_worker,
+                (self.offline_notification_spool_path,),
+            )
+
+        while not self.stopping:
+            self._collect_worker_stats()
+            self._restart_crashed_workers()
+            if time.monotonic() - self.last_stats_export > self.STATS_SEC_INTERVAL:
+                self._export_stats()
+            time.sleep(self.SUPERVISOR_SEC_INTERVAL)
+
+        self._stop_workers()
+
+    def get_aggregated_stats(self):
+        result = {
+            "workers_count": len(self.workers),
+            "alive_workers_count": len(
+                [e for e in self.workers.values() if e.is_alive()]
+            ),
+            "connected_clients_count": 0,
+            "application_data": {},
+            "handshake_stats": {},
+            "workers": [],
+        }
+        for worker_stats in self.worker_stats_dict.values():
+            result["connected_clients_count"] += worker_stats["connected_clients_count"]
+            for application, counter in worker_stats["application_data"].items():
+                result["application_data"][application] = (
+                    result["application_data"].get(application, 0) + counter
+                )
+            for name, counter in worker_stats.get("handshake_stats", {}).items():
+                result["handshake_stats"][name] = (
+                    result["handshake_stats"].get(name, 0) + counter
+                )
+            result["workers"].append(worker_stats)
+        return result
+
+    def _start_worker(self, worker_index, target, args, restart_delay_sec=0):
+        process = self.multiprocessing_context.Process(
+            target=target,
+            args=args,
+            name=f"chat-server-worker-{worker_index}",
+            daemon=False,
+        )
+        process.start()
+        worker = WorkerProcess(worker_index, process, target, args)
+        worker.restart_delay_sec = restart_delay_sec
+        self.workers[worker_index] = worker
+        LOGGER.info(f"Started chat server worker {worker_index} with pid {process.pid}")
+
+    def _restart_crashed_workers(self):
+        now = time.monotonic()
+        for worker_index, worker in list(self.workers.items()):
+            if self.stopping:
+                return
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    self._start_worker(
+                        worker_index,
+                        worker.target,
+                        worker.args,
+                        worker.restart_delay_sec,
+                    )
+                continue
+            if worker.process.is_alive():
+                continue
+
+            self.worker_stats_dict.pop(worker.process.pid, None)
+            if worker.process.exitcode == DrainService.EXIT_CODE:
+                # Drained by a manager message, its clients reconnect to the new worker and the other ones
+                LOGGER.info(
+                    f"Chat server worker {worker_index} (pid {worker.process.pid}) stopped after a drain. "
+                    f"Restarting."
+                )
+                worker.restart_delay_sec = 0
+                worker.restart_at = now
+                continue
+
+            LOGGER.error(
+                f"Chat server worker {worker_index} (pid {worker.process.pid}) exited with code "
+                f"{worker.process.exitcode}. Restarting."
+            )
+            # Back off if the worker keeps crashing right after the start
+            if now - worker.started_at < self.MIN_WORKER_UPTIME_SEC:
+                worker.restart_delay_sec = min(
+                    max(worker.restart_delay_sec * 2, 1), self.MAX_RESTART_DELAY_SEC
+                )
+            else:
+                worker.restart_delay_sec = 0
+            worker.restart_at = now + worker.restart_delay_sec
+
+    def _collect_worker_stats(self):
+        while True:
+            try:
+                worker_stats = self.worker_stats_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.worker_stats_dict[worker_stats["pid"]] = worker_stats
+
+    def _export_stats(self):
+        self.last_stats_export = time.monotonic()
+        stats = self.get_aggregated_stats()
+        LOGGER.info(
+            f"Chat server workers: {stats['alive_workers_count']}/{stats['workers_count']} alive, "
+            f"{stats['connected_clients_count']} connected clients, "
+            f"handshakes: {stats['handshake_stats']}"
+        )
+        if self.stats_file_path:
+            # Write and rename, so readers never see a partially written file
+            tmp_file_path = f"{self.stats_file_path}.tmp"
+            with open(tmp_file_path, "w") as stats_file:
+                json.dump(stats, stats_file)
+            os.replace(tmp_file_path, self.stats_file_path)
+
+    def _stop(self, signum, frame):
+        LOGGER.info(f"Received signal {signum}. Stopping chat server workers.")
+        self.stopping = True
+
+    def _stop_workers(self):
+        for worker in self.workers.values():
+            if worker.is_alive():
+                worker.process.terminate()
+
+        deadline = time.monotonic() + self.WORKER_STOP_TIMEOUT_SEC
+        for worker in self.workers.values():
+            if worker.restart_at is not None:
+                continue
+            worker.process.join(max(deadline - time.monotonic(), 0))
+            if worker.process.is_alive():
+                LOGGER.warning(
+                    f"Chat server worker {worker.worker_index} did not stop in time. Killing it."
+                )
+                worker.process.kill()
+                worker.process.join()
+        LOGGER.info("All chat server workers stopped")
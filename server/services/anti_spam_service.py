@@ -1,23 +1,68 @@
-from datetime import timedelta, datetime
-from server.utils.exceptions import MessageSpamException
+import math
 
+from server.utils.exceptions import MessageSpamException, MessageRateLimitedException
+from server.utils.utils import MessageType, TokenBucket
 
-class AntiSpamMixin:
 
-    MESSAGE_LIMIT_PER_MINUTE = 300
+class AntiSpamMixin:
+    """
+    Token bucket rate limiting of websocket messages. Every message type has a cost, so messages querying
+    DynamoDB (e.g. GET_HISTORY) use up the limit faster than chat messages. The limits can be overridden per
+    application with the "message_tokens_per_sec", "message_tokens_burst" and "message_type_costs" application
+    settings. A message over the limit is rejected with the time to retry after, and the connection is closed
+    only if the client keeps sending MAX_RATE_LIMITED_MESSAGES messages in a row over the limit. EPHEMERAL
+    messages (e.g. typing indicators) have their own limit, set with the "ephemeral_tokens_per_sec" and
+    "ephemeral_tokens_burst" application settings, and are dropped silently when it is exceeded.
+    """
 
-    def init_counter(self):
-        self.counter = 0
-        self.reset_counter_datetime = datetime.utcnow() + timedelta(minutes=1)
+    MESSAGE_TOKENS_PER_SEC = 5
+    MESSAGE_TOKENS_BURST = 60
+    DEFAULT_MESSAGE_TYPE_COST = 1
+    MESSAGE_TYPE_COSTS = {
+        MessageType.ROUTABLE: 1,
+        MessageType.SET_LAST_MESSAGE_READ: 1,
+        MessageType.GET_LAST_MESSAGES_READ: 2,
+        MessageType.GET_LAST_CHAT_ROOM_MESSAGE: 2,
+        MessageType.GET_UNREAD_MESSAGES_COUNT: 5,
+        MessageType.GET_HISTORY: 5,
+    }
+    MAX_RATE_LIMITED_MESSAGES = 20
+    EPHEMERAL_TOKENS_PER_SEC = 2
+    EPHEMERAL_TOKENS_BURST = 10
 
-    def check_anti_spam(self):
-        datetime_now = datetime.utcnow()
-        if datetime_now > self.reset_counter_datetime:
-            self.init_counter()
+    def init_rate_limiter(self, application_settings=None):
+        application_settings = application_settings or {}
+        self.message_type_costs = {
+            **self.MESSAGE_TYPE_COSTS,
+            **(application_settings.get("message_type_costs", None) or {}),
+        }
+        self.message_bucket = TokenBucket(
+            application_settings.get("message_tokens_per_sec", None)
+            or self.MESSAGE_TOKENS_PER_SEC,
+            application_settings.get("message_tokens_burst", None)
+            or self.MESSAGE_TOKENS_BURST,
+        )
+        self.ephemeral_bucket = TokenBucket(
+            application_settings.get("ephemeral_tokens_per_sec", None)
+            or self.EPHEMERAL_TOKENS_PER_SEC,
+            application_settings.get("ephemeral_tokens_burst", None)
+            or self.EPHEMERAL_TOKENS_BURST,
+        )
+        self.rate_limited_messages_count = 0
 
-        if (
-            self.counter >= self.MESSAGE_LIMIT_PER_MINUTE
-            and datetime_now < self.reset_counter_datetime
-        ):
+    def check_anti_spam(self, message_type=None) -> bool:
+        """
+        Returns False if the message has to be dropped.
+        """
+        if message_type == MessageType.EPHEMERAL:
+            return self.ephemeral_bucket.consume()
+        cost = self.message_type_costs.get(message_type, self.DEFAULT_MESSAGE_TYPE_COST)
+        if self.message_bucket.consume(cost):
+            self.rate_limited_messages_count = 0
+            return True
+        self.rate_limited_messages_count += 1
+        if self.rate_limited_messages_count >= self.MAX_RATE_LIMITED_MESSAGES:
             raise MessageSpamException()
-        self.counter = self.counter + 1
+        raise MessageRateLimitedException(
+            message_type, math.ceil(self.message_bucket.get_wait_sec(cost) * 1000)
+        )
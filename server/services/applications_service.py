@@ -1,45 +1,37 @@
+from types import MappingProxyType
+
+
 class ApplicationService:
 
     def __init__(self, context):
         self.context = context
-        self.applications_settings_dict = (
+        self.applications_settings_dict = MappingProxyType(
             {}
-        )  # Application identifier -> Application object
-        self.applications_dict = {}
-
-    def clear_application_settings(self):
-        self.applications_settings_dict.clear()
-
-    def set_application_settings(self, application_identifier, application):
-        self.applications_settings_dict[application_identifier] = application
+        )  # Application identifier -> Application object (read-only snapshot)
+
+    def set_applications_settings(self, applications_settings_dict):
+        """
+        Swaps the whole settings snapshot at once, so readers never see partially refreshed settings.
+        """
+        self.applications_settings_dict = MappingProxyType(
+            {
+                application_identifier: MappingProxyType(application)
+                for application_identifier, application in applications_settings_dict.items()
+            }
+        )
 
     def get_applications_settings(self):
         return self.applications_settings_dict
 
-    def increase_user_count(self, application_identifier):
+    def can_connect(self, application_identifier):
         if application_identifier not in self.applications_settings_dict:
             return False
         application_settings = self.applications_settings_dict[application_identifier]
         if not application_settings["is_chat_active"]:
             return False
-
-        if application_identifier not in self.applications_dict:
-            self.applications_dict[application_identifier] = 0
-
-        max_concurrent_online_users = application_settings[
-            "max_concurrent_online_users"
-        ]
-        if (
-            self.applications_dict[application_identifier]
-            >= max_concurrent_online_users
-        ):
-            return False
-        self.applications_dict[application_identifier] += 1
-        return True
-
-    def reduce_user_count(self, application_identifier):
-        if application_identifier in self.applications_dict:
-            self.applications_dict[application_identifier] -= 1
-
-    def get_applications_dict(self):
-        return self.applications_dict
+        return (
+            self.context.connection_registry.get_application_connections_count(
+                application_identifier
+            )
+            < application_settings["max_concurrent_online_users"]
+        )
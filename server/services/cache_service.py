@@ -1,5 +1,10 @@
+import asyncio
+import logging
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
+LOGGER = logging.getLogger("Server.CacheService")
+
 
 class CustomDataCacheService:
 
@@ -9,6 +14,7 @@ class CustomDataCacheService:
             {}
         )  # Identifier of a app user -> { 'expiry_date', 'custom_data' }
 
+    # Custom data changes are pushed with INVALIDATE messages, but their delivery is not guaranteed
     async def get_custom_data(self, app_user_identifier, cache_time_sec=60 * 60):
         if (
             app_user_identifier not in self.identifier_custom_data_dict
@@ -24,6 +30,12 @@ class CustomDataCacheService:
             }
         return self.identifier_custom_data_dict[app_user_identifier]["custom_data"]
 
+    def invalidate(self, app_user_identifier):
+        self.identifier_custom_data_dict.pop(app_user_identifier, None)
+
+    def invalidate_all(self):
+        self.identifier_custom_data_dict.clear()
+
     def _cache_expired(self, app_user_identifier):
         expiry_datetime = self.identifier_custom_data_dict[app_user_identifier][
             "expiry_datetime"
@@ -31,11 +43,69 @@ class CustomDataCacheService:
         return datetime.utcnow() > expiry_datetime
 
 
+class ChatRoomCacheService:
+    MAX_CACHED_CHAT_ROOMS = 100000
+
+    def __init__(self, context):
+        self.context = context
+        # Identifier of a chat room -> { 'chat_room', 'expiry_datetime' }, kept in LRU order
+        self.identifier_chat_room_dict = OrderedDict()
+
+    # Membership changes are pushed with INVALIDATE messages, but their delivery is not guaranteed, so the TTL is
+    # short: a member removed from a chat room is still let in for at most a minute
+    async def get_chat_room(self, chat_room_identifier, cache_time_sec=60):
+        if (
+            chat_room_identifier not in self.identifier_chat_room_dict
+            or self._cache_expired(chat_room_identifier)
+        ):
+            chat_room = await self.context.dynamodb_service.fetch_chat_room(
+                chat_room_identifier
+            )
+            if not chat_room:
+                # Do not cache missing chat rooms, they may be created in a moment
+                return chat_room
+
+            self.identifier_chat_room_dict[chat_room_identifier] = {
+                "chat_room": chat_room,
+                "expiry_datetime": datetime.utcnow()
+                + timedelta(seconds=cache_time_sec),
+            }
+            while len(self.identifier_chat_room_dict) > self.MAX_CACHED_CHAT_ROOMS:
+                self.identifier_chat_room_dict.popitem(last=False)
+        else:
+            self.identifier_chat_room_dict.move_to_end(chat_room_identifier)
+        return self.identifier_chat_room_dict[chat_room_identifier]["chat_room"]
+
+    def invalidate(self, chat_room_identifier):
+        self.identifier_chat_room_dict.pop(chat_room_identifier, None)
+
+    def invalidate_all(self):
+        self.identifier_chat_room_dict.clear()
+
+    def _cache_expired(self, chat_room_identifier):
+        expiry_datetime = self.identifier_chat_room_dict[chat_room_identifier][
+            "expiry_datetime"
+        ]
+        return datetime.utcnow() > expiry_datetime
+
+
 class DeviceFcmTokenCacheService:
+    MAX_CACHED_USERS = 100000
+    MAX_QUARANTINED_TOKENS = 100000
+    QUARANTINE_TIME_SEC = 60 * 60 * 24
+    FETCH_CONCURRENCY = 100
+    # FCM errors meaning that the token will never be valid again
+    INVALID_TOKEN_ERRORS = {"NotRegistered", "InvalidRegistration", "MismatchSenderId"}
 
     def __init__(self, context):
         self.context = context
-        self.user_identifier_fcm_tokens_dict = {}
+        # Identifier of a app user -> { 'fcm_tokens', 'application_identifier', 'expiry_datetime' }, kept in LRU order
+        self.user_identifier_fcm_tokens_dict = OrderedDict()
+        self.fcm_token_user_identifier_dict = (
+            {}
+        )  # Fcm token -> identifier of a app user
+        self.quarantined_fcm_tokens_dict = OrderedDict()  # Fcm token -> expiry datetime
+        self.fetch_semaphore = asyncio.Semaphore(self.FETCH_CONCURRENCY)
 
     async def get_user_identifier_fcm_tokens(
         self, app_user_identifier, cache_time_sec=60 * 60 * 12
@@ -44,23 +114,122 @@ class DeviceFcmTokenCacheService:
             app_user_identifier not in self.user_identifier_fcm_tokens_dict
             or self._cache_expired(app_user_identifier)
         ):
-            fcm_tokens = await self.context.dynamodb_service.fetch_device_fcm_tokens(
-                app_user_identifier
+            async with self.fetch_semaphore:
+                fcm_tokens = (
+                    await self.context.dynamodb_service.fetch_device_fcm_tokens(
+                        app_user_identifier
+                    )
+                )
+            self._set_user_identifier_fcm_tokens(
+                app_user_identifier, fcm_tokens, cache_time_sec
             )
-            application_identifier = app_user_identifier.split(":")[1]
+        else:
+            self.user_identifier_fcm_tokens_dict.move_to_end(app_user_identifier)
 
-            self.user_identifier_fcm_tokens_dict[app_user_identifier] = {
-                "fcm_tokens": fcm_tokens,
-                "application_identifier": application_identifier,
-                "expiry_datetime": datetime.utcnow()
-                + timedelta(seconds=cache_time_sec),
-            }
-        return (
-            self.user_identifier_fcm_tokens_dict[app_user_identifier]["fcm_tokens"],
-            self.user_identifier_fcm_tokens_dict[app_user_identifier][
-                "application_identifier"
+        entry = self.user_identifier_fcm_tokens_dict[app_user_identifier]
+        return entry["fcm_tokens"], entry["application_identifier"]
+
+    async def get_users_identifier_fcm_tokens(self, app_user_identifiers):
+        """
+        Returns { identifier of a app user -> (fcm tokens, application identifier) }. Users missing in the cache
+        are fetched concurrently, bounded by FETCH_CONCURRENCY.
+        """
+        app_user_identifiers = list(app_user_identifiers)
+        results = await asyncio.gather(
+            *[
+                self.get_user_identifier_fcm_tokens(app_user_identifier)
+                for app_user_identifier in app_user_identifiers
             ],
+            return_exceptions=True,
+        )
+
+        result = {}
+        for app_user_identifier, user_result in zip(app_user_identifiers, results):
+            if isinstance(user_result, Exception):
+                LOGGER.error(
+                    f"Cannot fetch device fcm tokens for user {app_user_identifier}: {str(user_result)}"
+                )
+                continue
+            result[app_user_identifier] = user_result
+        return result
+
+    def invalidate(self, app_user_identifier):
+        entry = self.user_identifier_fcm_tokens_dict.pop(app_user_identifier, None)
+        if entry:
+            for fcm_token in entry["fcm_tokens"]:
+                self.fcm_token_user_identifier_dict.pop(fcm_token, None)
+
+    def invalidate_all(self):
+        # Quarantined tokens are kept, they are invalid regardless of the session table
+        self.user_identifier_fcm_tokens_dict.clear()
+        self.fcm_token_user_identifier_dict.clear()
+
+    def handle_fcm_send_result(self, send_result):
+        """
+        Evicts tokens that FCM reported as no longer valid and quarantines them, so they are not used again even
+        if the session table still contains them.
+        """
+        invalid_fcm_tokens = [
+            fcm_token
+            for fcm_token, error in send_result.failed_tokens.items()
+            if error in self.INVALID_TOKEN_ERRORS
+        ]
+        if not invalid_fcm_tokens:
+            return
+
+        LOGGER.info(f"Quarantining {len(invalid_fcm_tokens)} invalid fcm tokens")
+        expiry_datetime = datetime.utcnow() + timedelta(
+            seconds=self.QUARANTINE_TIME_SEC
         )
+        for fcm_token in invalid_fcm_tokens:
+            self.quarantined_fcm_tokens_dict.pop(fcm_token, None)
+            self.quarantined_fcm_tokens_dict[fcm_token] = expiry_datetime
+
+            app_user_identifier = self.fcm_token_user_identifier_dict.pop(
+                fcm_token, None
+            )
+            if app_user_identifier in self.user_identifier_fcm_tokens_dict:
+                entry = self.user_identifier_fcm_tokens_dict[app_user_identifier]
+                entry["fcm_tokens"] = [e for e in entry["fcm_tokens"] if e != fcm_token]
+        self._prune_quarantined_fcm_tokens()
+
+    def _set_user_identifier_fcm_tokens(
+        self, app_user_identifier, fcm_tokens, cache_time_sec
+    ):
+        self.invalidate(app_user_identifier)
+        fcm_tokens = [
+            fcm_token
+            for fcm_token in fcm_tokens
+            if fcm_token and not self._is_quarantined(fcm_token)
+        ]
+        self.user_identifier_fcm_tokens_dict[app_user_identifier] = {
+            "fcm_tokens": fcm_tokens,
+            "application_identifier": app_user_identifier.split(":")[1],
+            "expiry_datetime": datetime.utcnow() + timedelta(seconds=cache_time_sec),
+        }
+        for fcm_token in fcm_tokens:
+            self.fcm_token_user_identifier_dict[fcm_token] = app_user_identifier
+
+        while len(self.user_identifier_fcm_tokens_dict) > self.MAX_CACHED_USERS:
+            self.invalidate(next(iter(self.user_identifier_fcm_tokens_dict)))
+
+    def _is_quarantined(self, fcm_token):
+        expiry_datetime = self.quarantined_fcm_tokens_dict.get(fcm_token, None)
+        return expiry_datetime is not None and datetime.utcnow() < expiry_datetime
+
+    def _prune_quarantined_fcm_tokens(self):
+        # Entries are kept in insertion order and all of them have the same lifetime, so the oldest are first
+        now = datetime.utcnow()
+        while self.quarantined_fcm_tokens_dict:
+            fcm_token, expiry_datetime = next(
+                iter(self.quarantined_fcm_tokens_dict.items())
+            )
+            if (
+                expiry_datetime > now
+                and len(self.quarantined_fcm_tokens_dict) <= self.MAX_QUARANTINED_TOKENS
+            ):
+                return
+            del self.quarantined_fcm_tokens_dict[fcm_token]
 
     def _cache_expired(self, app_user_identifier):
         expiry_datetime = self.user_identifier_fcm_tokens_dict[app_user_identifier][
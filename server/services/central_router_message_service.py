@@ -3,7 +3,7 @@ import logging
 
 from websockets.exceptions import WebSocketException
 
-from server.utils.utils import MessageType
+from server.utils.utils import MessageType, InvalidationType
 
 LOGGER = logging.getLogger("Server.DnsMessageService")
 
@@ -18,6 +18,9 @@ class DnsMessageService:
             MessageType.SET_LAST_MESSAGE_READ: self.routable_message_handler,
             MessageType.OFFLINE_NOTIFICATION: self.offline_notification_handler,
             MessageType.SYSTEM_ROUTABLE: self.routable_message_handler,
+            MessageType.EPHEMERAL: self.routable_message_handler,
+            MessageType.INVALIDATE: self.invalidate_message_handler,
+            MessageType.PRESENCE_DIGEST_MISMATCH: self.presence_digest_mismatch_handler,
         }
 
     async def handle_message(self, message: dict, websocket):
@@ -30,22 +33,26 @@ class DnsMessageService:
         #     'message': str
         # }
         LOGGER.debug("Received message from central router and sending to users")
+        # Only the app users of this chat server for messages of larger chat rooms
         application_user_identifiers = message["application_user_identifiers"]
         del message["application_user_identifiers"]
         message_dict = json.dumps(message)
 
         for user_identifier in application_user_identifiers:
-            if user_identifier in self.context.application_user_device_dict:
-                devices = self.context.application_user_device_dict[user_identifier]
-                for device_identifier, socket in devices.items():
-                    LOGGER.debug(
-                        f"Sending message to device {device_identifier} owned by user {user_identifier}"
-                    )
-                    try:
-                        # Ignore web socket exception, because one of the users could have disconnected already
-                        await socket.send(message_dict)
-                    except WebSocketException:
-                        pass
+            self.context.replay_buffer_service.record(
+                user_identifier, message, message_dict
+            )
+            for socket in self.context.connection_registry.get_user_websockets(
+                user_identifier
+            ):
+                LOGGER.debug(
+                    f"Sending message to device {socket.device_identifier} owned by user {user_identifier}"
+                )
+                try:
+                    # Ignore web socket exception, because one of the users could have disconnected already
+                    await socket.send(message_dict)
+                except WebSocketException:
+                    pass
 
     async def offline_notification_handler(self, message: dict, websocket):
         # Format
@@ -76,6 +83,69 @@ class DnsMessageService:
                     application_user_identifier, notification_message
                 )
 
+    async def invalidate_message_handler(self, message: dict, websocket):
+        # Format
+        # {
+        #     'type': 'INVALIDATE',
+        #     'cache': str (InvalidationType),
+        #     'identifiers': [str]
+        # }
+        cache = message["cache"]
+        identifiers = message.get("identifiers", [])
+        LOGGER.debug(f"Invalidating {cache} cache for: {identifiers}")
+
+        if cache == InvalidationType.CUSTOM_DATA:
+            for app_user_identifier in identifiers:
+                self.context.custom_data_cache_service.invalidate(app_user_identifier)
+        elif cache == InvalidationType.FCM_TOKENS:
+            for app_user_identifier in identifiers:
+                self.context.offline_notification_client.invalidate_fcm_tokens(
+                    app_user_identifier
+                )
+        elif cache == InvalidationType.CHAT_ROOM:
+            for chat_room_identifier in identifiers:
+                self.context.chat_room_cache_service.invalidate(chat_room_identifier)
+        elif cache == InvalidationType.APPLICATION_SETTINGS:
+            self.context.application_settings_client.request_refresh()
+        else:
+            LOGGER.warning(f"Received invalidation of unknown cache: {cache}")
+
+    async def presence_digest_mismatch_handler(self, message: dict, websocket):
+        # Format
+        # {
+        #     'type': 'PRESENCE_DIGEST_MISMATCH',
+        #     'bucket_indexes': [int]
+        # }
+        bucket_indexes = message["bucket_indexes"]
+        LOGGER.info(
+            f"Presence of {len(bucket_indexes)} buckets differs at central router, sending their users"
+        )
+        self.context.presence_digest_client.repaired_buckets_count += len(
+            bucket_indexes
+        )
+        # Sent in the same tick as the users are collected, so the following ADD and REMOVE messages stay valid
+        await websocket.send(
+            json.dumps(
+                {
+                    "type": MessageType.PRESENCE_BUCKETS_SYNC,
+                    "bucket_indexes": bucket_indexes,
+                    "application_user_identifiers": self.context.presence_digest_client.get_bucket_users(
+                        bucket_indexes
+                    ),
+                }
+            )
+        )
+
+    def invalidate_all_caches(self):
+        """
+        INVALIDATE messages broadcast while a central router link was down are lost, so everything is fetched again.
+        """
+        LOGGER.info("Invalidating all caches")
+        self.context.custom_data_cache_service.invalidate_all()
+        self.context.offline_notification_client.invalidate_all_fcm_tokens()
+        self.context.chat_room_cache_service.invalidate_all()
+        self.context.application_settings_client.request_refresh()
+
     async def sever_mode_handler(self, message: dict, websocket):
         self.context.central_router_client.set_operational(websocket)
 
@@ -101,13 +171,43 @@ class DnsMessageService:
         }
         await self.context.central_router_client.send_message_to_all_routers(message)
 
+    async def send_deferred_offline_notifications_message(
+        self, application_user_identifier, notifications
+    ):
+        """
+        The central router sends the notifications back as OFFLINE_NOTIFICATION messages, unless the app user is
+        connected to another chat server.
+        """
+        if not self.context.central_router_client.is_central_router_available():
+            for notification in notifications:
+                self.context.offline_notification_client.set_offline_application_user(
+                    application_user_identifier,
+                    {**notification, "click_action": "CHAT_NOTIFICATION"},
+                )
+            return
+        message = {
+            "type": MessageType.DEFERRED_OFFLINE_NOTIFICATIONS,
+            "application_user_identifier": application_user_identifier,
+            "notifications": notifications,
+        }
+        await self.context.central_router_client.send_message(message)
+
+    async def send_drain_message(self):
+        LOGGER.info("Sending drain message to central routers")
+        message = {"type": MessageType.DRAIN}
+        await self.context.central_router_client.send_message_to_all_routers(message)
+
     async def send_full_sync_message(self, websocket):
-        users_count = len(self.context.application_user_device_dict.keys())
-        LOGGER.info(f"Sending init message to central router with {users_count} users")
+        self.context.replay_buffer_service.reset()
+        # App users within the resume window stay registered too
+        application_user_identifiers = list(
+            self.context.replay_buffer_service.get_application_user_identifiers()
+        )
+        LOGGER.info(
+            f"Sending init message to central router with {len(application_user_identifiers)} users"
+        )
         message = {
             "type": MessageType.FULL_SYNC,
-            "application_user_identifiers": list(
-                self.context.application_user_device_dict.keys()
-            ),
+            "application_user_identifiers": application_user_identifiers,
         }
         await websocket.send(json.dumps(message))
@@ -0,0 +1,158 @@
+import time
+
+from websockets.extensions.permessage_deflate import (
+    ClientPerMessageDeflateFactory,
+    PerMessageDeflate,
+    ServerPerMessageDeflateFactory,
+)
+from websockets.frames import CTRL_OPCODES, OP_CONT
+
+
+class CompressionStats:
+
+    def __init__(self):
+        self.compressed_frames_count = 0
+        self.skipped_frames_count = 0
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_cpu_sec = 0
+        self.decompress_cpu_sec = 0
+
+    def to_dict(self):
+        return {
+            "compressed_frames_count": self.compressed_frames_count,
+            "skipped_frames_count": self.skipped_frames_count,
+            "saved_bytes": self.uncompressed_bytes - self.compressed_bytes,
+            "compress_cpu_ms": round(self.compress_cpu_sec * 1000, 2),
+            "decompress_cpu_ms": round(self.decompress_cpu_sec * 1000, 2),
+        }
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """
+    permessage-deflate which sends messages smaller than min_size uncompressed (RSV1 unset), because compressing
+    tiny frames costs CPU and saves no bandwidth.
+    """
+
+    def __init__(self, extension: PerMessageDeflate, min_size, stats):
+        super().__init__(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+        )
+        self.min_size = min_size
+        self.stats = stats
+
+    def encode(self, frame):
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        # Only whole messages can be skipped, fragments of a compressed message must be compressed too
+        if (
+            frame.opcode is not OP_CONT
+            and frame.fin
+            and len(frame.data) < self.min_size
+        ):
+            self.stats.skipped_frames_count += 1
+            return frame
+
+        started_at = time.thread_time()
+        compressed_frame = super().encode(frame)
+        self.stats.compress_cpu_sec += time.thread_time() - started_at
+        self.stats.compressed_frames_count += 1
+        self.stats.uncompressed_bytes += len(frame.data)
+        self.stats.compressed_bytes += len(compressed_frame.data)
+        return compressed_frame
+
+    def decode(self, frame, *args, **kwargs):
+        started_at = time.thread_time()
+        decompressed_frame = super().decode(frame, *args, **kwargs)
+        self.stats.decompress_cpu_sec += time.thread_time() - started_at
+        return decompressed_frame
+
+
+class ThresholdServerPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+
+    def __init__(self, min_size, window_bits, mem_level, context_takeover, stats):
+        super().__init__(
+            server_no_context_takeover=not context_takeover,
+            server_max_window_bits=window_bits,
+            compress_settings={"memLevel": mem_level},
+        )
+        self.min_size = min_size
+        self.stats = stats
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(
+            params, accepted_extensions
+        )
+        return response_params, ThresholdPerMessageDeflate(
+            extension, self.min_size, self.stats
+        )
+
+
+class ThresholdClientPerMessageDeflateFactory(ClientPerMessageDeflateFactory):
+
+    def __init__(self, min_size, window_bits, mem_level, context_takeover, stats):
+        super().__init__(
+            client_no_context_takeover=not context_takeover,
+            client_max_window_bits=window_bits,
+            compress_settings={"memLevel": mem_level},
+        )
+        self.min_size = min_size
+        self.stats = stats
+
+    def process_response_params(self, params, accepted_extensions):
+        extension = super().process_response_params(params, accepted_extensions)
+        return ThresholdPerMessageDeflate(extension, self.min_size, self.stats)
+
+
+class CompressionService:
+    """
+    Compression policy of client websockets (see WebsocketMemoryProfile) and of the links to the central routers.
+    Chat messages are small and compress badly, while history pages and CONNECTED_USERS_INFO responses compress
+    well, so only messages of at least the minimum size are compressed. Saved bytes and CPU time are reported in
+    the worker stats, to tune bandwidth against cores.
+    """
+
+    ROUTER_LINK_MIN_SIZE = 1024
+    ROUTER_LINK_WINDOW_BITS = 15
+    ROUTER_LINK_MEM_LEVEL = 8
+    # Router links are long lived and carry similar messages, so keeping the context pays off
+    ROUTER_LINK_CONTEXT_TAKEOVER = True
+
+    def __init__(self, context):
+        self.context = context
+        self.client_stats = CompressionStats()
+        self.router_link_stats = CompressionStats()
+
+    def get_client_extensions(self, profile):
+        if not profile.compression:
+            return None
+        return [
+            ThresholdServerPerMessageDeflateFactory(
+                profile.compression_min_size,
+                profile.compression_window_bits,
+                profile.compression_mem_level,
+                profile.compression_context_takeover,
+                self.client_stats,
+            )
+        ]
+
+    def get_router_link_extensions(self):
+        return [
+            ThresholdClientPerMessageDeflateFactory(
+                self.ROUTER_LINK_MIN_SIZE,
+                self.ROUTER_LINK_WINDOW_BITS,
+                self.ROUTER_LINK_MEM_LEVEL,
+                self.ROUTER_LINK_CONTEXT_TAKEOVER,
+                self.router_link_stats,
+            )
+        ]
+
+    def get_stats(self):
+        return {
+            "clients": self.client_stats.to_dict(),
+            "central_routers": self.router_link_stats.to_dict(),
+        }
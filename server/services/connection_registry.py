@@ -0,0 +1,126 @@
+class Connection:
+    __slots__ = (
+        "websocket",
+        "application_identifier",
+        "application_user_identifier",
+        "device_identifier",
+    )
+
+    def __init__(
+        self,
+        websocket,
+        application_identifier,
+        application_user_identifier=None,
+        device_identifier=None,
+    ):
+        self.websocket = websocket
+        self.application_identifier = application_identifier
+        # None for manager connections
+        self.application_user_identifier = application_user_identifier
+        self.device_identifier = device_identifier
+
+
+class ConnectionRegistry:
+    """
+    All websocket connections of the chat server, indexed by websocket, by application and by app user. Every
+    connection is registered and unregistered only here, so the indexes and counters always agree.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.connection_dict = {}  # Websocket -> Connection (object)
+        # Application identifier -> number of connections, including manager connections
+        self.application_connections_count_dict = {}
+        # Identifier of a app user -> { Device identifier -> Connection (object) }
+        self.user_device_connection_dict = {}
+
+    def register(
+        self,
+        websocket,
+        application_identifier,
+        application_user_identifier=None,
+        device_identifier=None,
+    ) -> (Connection, bool):
+        """
+        Returns the connection and whether it is the first connection of the app user.
+        """
+        connection = Connection(
+            websocket,
+            application_identifier,
+            application_user_identifier,
+            device_identifier,
+        )
+        self.connection_dict[websocket] = connection
+        self.application_connections_count_dict[application_identifier] = (
+            self.application_connections_count_dict.get(application_identifier, 0) + 1
+        )
+        if application_user_identifier is None:
+            return connection, False
+
+        is_first_user_connection = (
+            application_user_identifier not in self.user_device_connection_dict
+        )
+        if is_first_user_connection:
+            self.user_device_connection_dict[application_user_identifier] = {}
+        # A reconnecting device replaces its previous connection, which is still counted until it is unregistered
+        self.user_device_connection_dict[application_user_identifier][
+            device_identifier
+        ] = connection
+        return connection, is_first_user_connection
+
+    def unregister(self, websocket) -> (Connection, bool):
+        """
+        Returns the removed connection (None if the websocket was not registered) and whether it was the last
+        connection of the app user.
+        """
+        connection = self.connection_dict.pop(websocket, None)
+        if connection is None:
+            return None, False
+
+        application_identifier = connection.application_identifier
+        # Applications are kept with 0 connections, so the Chat API sees their count dropping to 0
+        self.application_connections_count_dict[application_identifier] -= 1
+
+        application_user_identifier = connection.application_user_identifier
+        devices = self.user_device_connection_dict.get(application_user_identifier)
+        if (
+            devices is None
+            or devices.get(connection.device_identifier) is not connection
+        ):
+            return connection, False
+        del devices[connection.device_identifier]
+        if devices:
+            return connection, False
+        del self.user_device_connection_dict[application_user_identifier]
+        return connection, True
+
+    def get_user_websockets(self, application_user_identifier):
+        devices = self.user_device_connection_dict.get(application_user_identifier)
+        if not devices:
+            return []
+        return [connection.websocket for connection in devices.values()]
+
+    def get_user_websockets_list(self):
+        return [
+            connection.websocket
+            for devices in self.user_device_connection_dict.values()
+            for connection in devices.values()
+        ]
+
+    def get_user_device_connection_dict(self):
+        return self.user_device_connection_dict
+
+    def get_application_user_identifiers(self):
+        return self.user_device_connection_dict.keys()
+
+    def get_users_count(self):
+        return len(self.user_device_connection_dict)
+
+    def get_connections_count(self):
+        return len(self.connection_dict)
+
+    def get_application_connections_count(self, application_identifier):
+        return self.application_connections_count_dict.get(application_identifier, 0)
+
+    def get_application_connections_count_dict(self):
+        return self.application_connections_count_dict
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import logging
+import random
+
+from websockets.exceptions import WebSocketException
+
+LOGGER = logging.getLogger("Server.DrainService")
+
+
+class DrainService:
+    """
+    Gracefully empties the chat server before it is stopped. New handshakes are rejected, the central routers
+    forget all users of this server at once and clients are disconnected gradually over the drain window with a
+    reconnect delay hint, so they do not reconnect to the remaining servers all at the same moment. Finally the
+    pending offline notifications and in-flight message handlers are flushed.
+    """
+
+    DRAIN_WINDOW_SEC = 20
+    MAX_RECONNECT_DELAY_MS = 30000
+    # Close code 1012: Service Restart
+    CLOSE_CODE = 1012
+    FLUSH_TIMEOUT_SEC = 5
+    # Exit code of a worker process which stopped after a drain, so the supervisor does not take it for a crash
+    EXIT_CODE = 75
+
+    def __init__(self, context):
+        self.context = context
+        self.draining = False
+        self.drained_event = asyncio.Event()
+        # Kept, because the event loop only keeps a weak reference to tasks
+        self.drain_task = None
+
+    def is_draining(self):
+        return self.draining
+
+    def request_drain(self, drain_window_sec=None):
+        if self.draining or self.drain_task is not None:
+            return
+        self.drain_task = asyncio.create_task(self.drain(drain_window_sec))
+
+    async def drain(self, drain_window_sec=None):
+        if self.draining:
+            return
+        self.draining = True
+        drain_window_sec = (
+            self.DRAIN_WINDOW_SEC if drain_window_sec is None else drain_window_sec
+        )
+        try:
+            await self.context.central_router_message_service.send_drain_message()
+            await self._close_client_connections(drain_window_sec)
+            await self._flush()
+        except Exception as e:
+            LOGGER.exception(f"Exception while draining the chat server: {str(e)}")
+        finally:
+            LOGGER.info("Chat server drained")
+            self.drained_event.set()
+
+    async def wait_drained(self):
+        await self.drained_event.wait()
+
+    async def _close_client_connections(self, drain_window_sec):
+        websockets = self.context.connection_registry.get_user_websockets_list()
+        LOGGER.info(
+            f"Draining {len(websockets)} client connections in {drain_window_sec} seconds"
+        )
+        if not websockets:
+            return
+
+        close_sec_interval = drain_window_sec / len(websockets)
+        close_tasks = []
+        for websocket in websockets:
+            reason = json.dumps(
+                {"reconnect_delay_ms": random.randint(0, self.MAX_RECONNECT_DELAY_MS)}
+            )
+            close_tasks.append(
+                asyncio.create_task(self._close_websocket(websocket, reason))
+            )
+            await asyncio.sleep(close_sec_interval)
+        await asyncio.gather(*close_tasks)
+
+    async def _close_websocket(self, websocket, reason):
+        try:
+            await websocket.close(self.CLOSE_CODE, reason)
+        except WebSocketException:
+            # The client has already disconnected
+            pass
+
+    async def _flush(self):
+        # Message handlers still running may be writing last message read records
+        try:
+            await asyncio.wait_for(
+                self.context.fair_scheduler_service.wait_idle(),
+                self.FLUSH_TIMEOUT_SEC,
+            )
+        except asyncio.TimeoutError:
+            LOGGER.warning("Message handlers did not finish before the drain timeout")
+        await self.context.offline_notification_client.flush_pending()
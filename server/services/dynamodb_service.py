@@ -170,9 +170,15 @@ class DynamodbService:
         )
 
     async def create_chat_message(
-        self, chat_room_identifier, application_user_identifier, message
+        self,
+        chat_room_identifier,
+        application_user_identifier,
+        message,
+        message_timestamp_identifier=None,
     ):
-        message_timestamp_identifier = time.time_ns()  # Unix time in nanoseconds (!)
+        if message_timestamp_identifier is None:
+            # Unix time in nanoseconds (!)
+            message_timestamp_identifier = time.time_ns()
         data = {
             "chat_room_identifier": chat_room_identifier,
             "message": message,
@@ -0,0 +1,136 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+LOGGER = logging.getLogger("Server.FairSchedulerService")
+
+
+class ApplicationQueueStats:
+
+    def __init__(self):
+        self.handled_count = 0
+        self.total_wait_sec = 0
+        self.max_wait_sec = 0
+
+    def add_wait(self, wait_sec):
+        self.handled_count += 1
+        self.total_wait_sec += wait_sec
+        self.max_wait_sec = max(self.max_wait_sec, wait_sec)
+
+    def to_dict(self):
+        return {
+            "handled_count": self.handled_count,
+            "avg_wait_ms": round(self.total_wait_sec * 1000 / self.handled_count, 2),
+            "max_wait_ms": round(self.max_wait_sec * 1000, 2),
+        }
+
+
+class FairSchedulerService:
+    """
+    Weighted fair queueing of message handlers across applications. At most MAX_CONCURRENT_HANDLERS handlers run
+    at once; when all slots are taken, waiting handlers are started in the order of their virtual finish time, so
+    an application sending a lot of messages cannot starve the others. The weight of an application is taken
+    from the "scheduler_weight" application setting.
+    """
+
+    MAX_CONCURRENT_HANDLERS = 100
+    DEFAULT_WEIGHT = 1
+
+    def __init__(self, context):
+        self.context = context
+        self.running_handlers_count = 0
+        self.virtual_time = 0
+        # Application identifier -> virtual finish time of its last queued handler
+        self.application_finish_time_dict = {}
+        # Heap of (virtual finish time, sequence number, future)
+        self.waiting_handlers = []
+        self.sequence = itertools.count()
+        # Application identifier -> ApplicationQueueStats (object), reset on every get_stats() call
+        self.application_queue_stats_dict = {}
+
+    async def run(self, application_identifier, handler, *args):
+        enqueued_at = time.monotonic()
+        if self.running_handlers_count < self.MAX_CONCURRENT_HANDLERS:
+            self.running_handlers_count += 1
+        else:
+            await self._wait_for_slot(application_identifier)
+        self._get_application_queue_stats(application_identifier).add_wait(
+            time.monotonic() - enqueued_at
+        )
+
+        try:
+            return await handler(*args)
+        finally:
+            self._release_slot()
+
+    async def wait_idle(self):
+        while self.running_handlers_count:
+            await asyncio.sleep(0.1)
+
+    def get_stats(self):
+        """
+        Returns queue stats per application since the previous call.
+        """
+        application_queue_stats_dict = self.application_queue_stats_dict
+        self.application_queue_stats_dict = {}
+        return {
+            application_identifier: stats.to_dict()
+            for application_identifier, stats in application_queue_stats_dict.items()
+        }
+
+    async def _wait_for_slot(self, application_identifier):
+        weight = self._get_weight(application_identifier)
+        finish_time = (
+            max(
+                self.virtual_time,
+                self.application_finish_time_dict.get(application_identifier, 0),
+            )
+            + 1 / weight
+        )
+        self.application_finish_time_dict[application_identifier] = finish_time
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(
+            self.waiting_handlers, (finish_time, next(self.sequence), future)
+        )
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancellation
+            if future.done() and not future.cancelled():
+                self._release_slot()
+            raise
+
+    def _release_slot(self):
+        while self.waiting_handlers:
+            finish_time, _, future = heapq.heappop(self.waiting_handlers)
+            if future.cancelled():
+                continue
+            # The slot is handed over directly, so the running handlers count does not change
+            self.virtual_time = finish_time
+            future.set_result(None)
+            return
+        self.running_handlers_count -= 1
+        if not self.running_handlers_count:
+            # Nothing is waiting, so the finish times of idle applications are not needed anymore
+            self.virtual_time = 0
+            self.application_finish_time_dict = {}
+
+    def _get_weight(self, application_identifier):
+        application_settings = (
+            self.context.applications_service.get_applications_settings().get(
+                application_identifier, None
+            )
+        )
+        if application_settings is None:
+            return self.DEFAULT_WEIGHT
+        return application_settings.get("scheduler_weight", None) or self.DEFAULT_WEIGHT
+
+    def _get_application_queue_stats(self, application_identifier):
+        if application_identifier not in self.application_queue_stats_dict:
+            self.application_queue_stats_dict[application_identifier] = (
+                ApplicationQueueStats()
+            )
+        return self.application_queue_stats_dict[application_identifier]
@@ -0,0 +1,117 @@
+import logging
+import math
+import random
+from http import HTTPStatus
+from typing import Optional
+
+from server.utils.utils import TokenBucket
+
+LOGGER = logging.getLogger("Server.HandshakeAdmissionService")
+
+
+class HandshakeAdmissionService:
+    """
+    Protects the server against reconnect storms. Every handshake costs a DynamoDB session lookup and a central
+    router update, so only a limited number of handshakes is processed at once and every application has its own
+    handshake rate. The rate is charged only after the session is validated, so handshakes with forged tokens
+    cannot use up the rate of an application. Rejected clients get 503 with a jittered Retry-After, so their
+    reconnects are spread in time.
+    """
+
+    MAX_IN_PROGRESS_HANDSHAKES = 100
+    # Can be overridden per application with the "max_handshakes_per_sec" application setting
+    HANDSHAKES_PER_SEC = 50
+    HANDSHAKES_BURST_SEC = 2
+    MIN_RETRY_AFTER_SEC = 1
+    RETRY_AFTER_JITTER_SEC = 5
+    # Applications missing in application settings share a single bucket
+    UNKNOWN_APPLICATION_KEY = None
+    SERVER_BUSY_MESSAGE = "Server is overloaded. Retry later."
+
+    def __init__(self, context):
+        self.context = context
+        self.in_progress_handshakes_count = 0
+        # Application identifier -> TokenBucket (object)
+        self.application_handshake_bucket_dict = {}
+        self.admitted_count = 0
+        self.rejected_concurrency_count = 0
+        self.rejected_rate_count = 0
+        self.rejected_draining_count = 0
+
+    def admit(self) -> Optional[tuple]:
+        """
+        Returns an error response if the handshake cannot be processed now. Every admitted handshake must be
+        released with release().
+        """
+        if self.context.drain_service.is_draining():
+            self.rejected_draining_count += 1
+            return self._get_busy_response(0)
+
+        if self.in_progress_handshakes_count >= self.MAX_IN_PROGRESS_HANDSHAKES:
+            self.rejected_concurrency_count += 1
+            LOGGER.debug("Rejecting handshake: too many handshakes in progress")
+            return self._get_busy_response(0)
+
+        self.in_progress_handshakes_count += 1
+        self.admitted_count += 1
+        return None
+
+    def admit_application(self, application_identifier) -> Optional[tuple]:
+        """
+        Returns an error response if the handshake rate of the application is exceeded. Must be called once the
+        session of the admitted handshake is validated.
+        """
+        bucket = self._get_handshake_bucket(application_identifier)
+        if not bucket.consume():
+            self.rejected_rate_count += 1
+            LOGGER.debug(
+                f"Rejecting handshake: handshake rate exceeded for application {application_identifier}"
+            )
+            return self._get_busy_response(bucket.get_wait_sec())
+        return None
+
+    def release(self):
+        self.in_progress_handshakes_count -= 1
+
+    def get_stats(self):
+        return {
+            "in_progress": self.in_progress_handshakes_count,
+            "admitted": self.admitted_count,
+            "rejected_concurrency": self.rejected_concurrency_count,
+            "rejected_rate": self.rejected_rate_count,
+            "rejected_draining": self.rejected_draining_count,
+        }
+
+    def _get_handshake_bucket(self, application_identifier):
+        application_settings = (
+            self.context.applications_service.get_applications_settings().get(
+                application_identifier, None
+            )
+        )
+        if application_settings is None:
+            application_identifier = self.UNKNOWN_APPLICATION_KEY
+            handshakes_per_sec = self.HANDSHAKES_PER_SEC
+        else:
+            handshakes_per_sec = (
+                application_settings.get("max_handshakes_per_sec", None)
+                or self.HANDSHAKES_PER_SEC
+            )
+
+        bucket = self.application_handshake_bucket_dict.get(application_identifier)
+        if bucket is None or bucket.rate != handshakes_per_sec:
+            bucket = TokenBucket(
+                handshakes_per_sec, handshakes_per_sec * self.HANDSHAKES_BURST_SEC
+            )
+            self.application_handshake_bucket_dict[application_identifier] = bucket
+        return bucket
+
+    def _get_busy_response(self, wait_sec):
+        retry_after_sec = math.ceil(
+            max(wait_sec, self.MIN_RETRY_AFTER_SEC)
+            + random.uniform(0, self.RETRY_AFTER_JITTER_SEC)
+        )
+        return (
+            HTTPStatus.SERVICE_UNAVAILABLE,
+            [("Retry-After", str(retry_after_sec))],
+            self.SERVER_BUSY_MESSAGE,
+        )
@@ -0,0 +1,61 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from server.utils.utils import DecimalEncoder
+
+
+class JsonEncodingService:
+    """
+    Encodes responses to JSON. History pages and CONNECTED_USERS_INFO snapshots can take tens of milliseconds to
+    encode, which would block every other socket of the server, so payloads estimated to be large are encoded in
+    a worker thread. The encoder still holds the GIL, but the event loop gets its share of it every switch
+    interval instead of waiting for the whole encode.
+    """
+
+    # Payloads with at least this many items (e.g. messages of a history page) are encoded in a worker thread
+    OFFLOAD_MIN_ITEMS = 100
+    MAX_WORKERS = 2
+
+    def __init__(self, context):
+        self.context = context
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.MAX_WORKERS, thread_name_prefix="JsonEncoding"
+        )
+        self.inline_count = 0
+        self.offloaded_count = 0
+
+    @staticmethod
+    def estimate_items_count(data):
+        """
+        Cheap size estimate: the number of top level values plus the items of top level lists and dicts.
+        Responses keep their bulk (messages, users) one level deep.
+        """
+        if not isinstance(data, (dict, list)):
+            return 1
+        values = data.values() if isinstance(data, dict) else data
+        return len(data) + sum(
+            len(value) for value in values if isinstance(value, (dict, list))
+        )
+
+    async def dumps(self, data):
+        """
+        Must not be passed data that is changed while it is being encoded.
+        """
+        if self.estimate_items_count(data) < self.OFFLOAD_MIN_ITEMS:
+            self.inline_count += 1
+            return json.dumps(data, cls=DecimalEncoder)
+
+        self.offloaded_count += 1
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, lambda: json.dumps(data, cls=DecimalEncoder)
+        )
+
+    def get_stats(self):
+        stats = {
+            "inline_count": self.inline_count,
+            "offloaded_count": self.offloaded_count,
+        }
+        self.inline_count = 0
+        self.offloaded_count = 0
+        return stats
@@ -1,10 +1,15 @@
 import json
 
-from server.utils.exceptions import MissingRequiredFieldException
+from server.services.message_schema import decode_integer
+from server.utils.exceptions import (
+    InvalidFieldException,
+    MissingRequiredFieldException,
+)
 
 
 class ManagerMessageType:
     CONNECTED_USERS_INFO = "CONNECTED_USERS_INFO"
+    DRAIN = "DRAIN"
 
 
 class ManagerMessageHandlerService:
@@ -12,7 +17,8 @@ class ManagerMessageHandlerService:
     def __init__(self, context):
         self.context = context
         self.message_type_handlers = {
-            ManagerMessageType.CONNECTED_USERS_INFO: self.connected_users_info_message_handler
+            ManagerMessageType.CONNECTED_USERS_INFO: self.connected_users_info_message_handler,
+            ManagerMessageType.DRAIN: self.drain_message_handler,
         }
 
     async def handle_message(self, message, websocket):
@@ -23,20 +29,35 @@ class ManagerMessageHandlerService:
 
     async def connected_users_info_message_handler(self, message, websocket):
         data = {
-            "counter": len(self.context.application_user_device_dict),
+            "counter": self.context.connection_registry.get_users_count(),
             "identifier": str(self.context.websocket_server_identifier),
             "data": {},
         }
-        for (
-            application_user,
-            devices,
-        ) in self.context.application_user_device_dict.items():
+        # Copied, because users can connect or disconnect while custom data is fetched
+        for application_user, devices in list(
+            self.context.connection_registry.get_user_device_connection_dict().items()
+        ):
             data["data"][application_user] = {
-                "devices": [],
+                "devices": list(devices.keys()),
                 "custom_data": await self.context.custom_data_cache_service.get_custom_data(
                     application_user
                 ),
             }
-            for device, _ in devices.items():
-                data["data"][application_user]["devices"].append(device)
-        await websocket.send(json.dumps(data))
+        await websocket.send(await self.context.json_encoding_service.dumps(data))
+
+    async def drain_message_handler(self, message, websocket):
+        # Format
+        # {
+        #     'type': 'DRAIN',
+        #     'drain_window_sec': int (optional)
+        # }
+        drain_window_sec = message.get("drain_window_sec", None)
+        if drain_window_sec is not None:
+            drain_window_sec = decode_integer("drain_window_sec", drain_window_sec)
+            if drain_window_sec < 0:
+                raise InvalidFieldException("drain_window_sec", "non-negative integer")
+        # The drain runs in the background, it waits for all running message handlers including this one
+        self.context.drain_service.request_drain(drain_window_sec)
+        await websocket.send(
+            json.dumps({"type": ManagerMessageType.DRAIN, "draining": True})
+        )
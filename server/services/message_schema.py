@@ -0,0 +1,127 @@
+from server.services.websocket_message_service import WebsocketMessage
+from server.settings.settings import MAX_DYNAMO_MESSAGE_LIMIT
+from server.utils.exceptions import InvalidFieldException, MissingRequiredFieldException
+from server.utils.utils import MessageType
+
+
+def decode_string(field_name, value):
+    if not isinstance(value, str):
+        raise InvalidFieldException(field_name, "string")
+    return value
+
+
+def decode_integer(field_name, value):
+    # Timestamps identifiers are sent both as numbers and as strings
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise InvalidFieldException(field_name, "integer")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise InvalidFieldException(field_name, "integer")
+
+
+def decode_message_limit(field_name, value):
+    value = decode_integer(field_name, value)
+    if not 1 <= value <= MAX_DYNAMO_MESSAGE_LIMIT:
+        raise InvalidFieldException(
+            field_name, f"integer between 1 and {MAX_DYNAMO_MESSAGE_LIMIT}"
+        )
+    return value
+
+
+def decode_string_list(field_name, value):
+    if not isinstance(value, list) or not all(isinstance(e, str) for e in value):
+        raise InvalidFieldException(field_name, "list of strings")
+    return value
+
+
+class Field:
+
+    def __init__(self, decoder, required=True, default=None):
+        self.decoder = decoder
+        self.required = required
+        self.default = default
+
+
+class MessageSchema:
+    """
+    Decodes and validates a client message of a single type into a slotted struct in one pass, so malformed
+    messages are rejected before any DynamoDB call and the values are converted only once.
+    """
+
+    def __init__(self, message_type, fields: dict):
+        self.message_type = message_type
+        struct_name = "".join(e.capitalize() for e in message_type.split("_"))
+        self.struct_class = type(
+            f"{struct_name}Message", (WebsocketMessage,), {"__slots__": tuple(fields)}
+        )
+        # Compiled to tuples, so decoding does not look up Field attributes
+        self.fields = tuple(
+            (name, field.decoder, field.required, field.default)
+            for name, field in fields.items()
+        )
+
+    def decode(self, message_dict) -> WebsocketMessage:
+        message = self.struct_class(
+            self.message_type, message_dict.get("request_id", None)
+        )
+        for name, decoder, required, default in self.fields:
+            value = message_dict.get(name, None)
+            if required:
+                if not value:
+                    raise MissingRequiredFieldException(name)
+                value = decoder(name, value)
+            elif value is None:
+                value = default
+            else:
+                value = decoder(name, value)
+            setattr(message, name, value)
+        return message
+
+
+MESSAGE_SCHEMAS = {
+    schema.message_type: schema
+    for schema in (
+        MessageSchema(
+            MessageType.ROUTABLE,
+            {
+                "chat_room_identifier": Field(decode_string),
+                "message": Field(decode_string),
+            },
+        ),
+        MessageSchema(
+            MessageType.EPHEMERAL,
+            {
+                "chat_room_identifier": Field(decode_string),
+                "message": Field(decode_string),
+            },
+        ),
+        MessageSchema(
+            MessageType.GET_HISTORY,
+            {
+                "chat_room_identifier": Field(decode_string),
+                "from_message_timestamp_identifier": Field(decode_integer),
+                "limit": Field(decode_message_limit, required=False, default=20),
+            },
+        ),
+        MessageSchema(
+            MessageType.SET_LAST_MESSAGE_READ,
+            {
+                "chat_room_identifier": Field(decode_string),
+                "message_timestamp_identifier": Field(decode_integer),
+            },
+        ),
+        MessageSchema(
+            MessageType.GET_LAST_MESSAGES_READ,
+            {"chat_room_identifier": Field(decode_string)},
+        ),
+        MessageSchema(
+            MessageType.GET_LAST_CHAT_ROOM_MESSAGE,
+            {"chat_room_identifiers": Field(decode_string_list)},
+        ),
+        MessageSchema(
+            MessageType.GET_UNREAD_MESSAGES_COUNT,
+            {"chat_room_identifiers": Field(decode_string_list)},
+        ),
+    )
+}
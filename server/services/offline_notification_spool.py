@@ -0,0 +1,106 @@
+import json
+import logging
+import sqlite3
+import time
+
+LOGGER = logging.getLogger("Server.OfflineNotificationSpool")
+
+
+class OfflineNotificationSpool:
+    """
+    Append-only spool of offline notifications kept in SQLite in WAL mode. Chat server workers append to it and
+    the OfflineNotificationWorker consumes it, remembering the last consumed row in a checkpoint. All methods are
+    blocking and should be called from an executor.
+    """
+
+    ALL_APP_USERS = "*"
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False
+            )
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS offline_notification ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "app_user_identifier TEXT NOT NULL, "
+                "message TEXT NOT NULL, "
+                "created_at REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoint ("
+                "consumer TEXT PRIMARY KEY, "
+                "last_id INTEGER NOT NULL)"
+            )
+        return self.connection
+
+    def append(self, offline_notifications):
+        """
+        Appends [(identifier of a app user, message dict)] in a single transaction. A message of None means that
+        fcm tokens of the user should be invalidated, of all users if the identifier is ALL_APP_USERS.
+        """
+        connection = self.connect()
+        now = time.time()
+        with connection:
+            connection.executemany(
+                "INSERT INTO offline_notification (app_user_identifier, message, created_at) VALUES (?, ?, ?)",
+                [
+                    (app_user_identifier, json.dumps(message), now)
+                    for app_user_identifier, message in offline_notifications
+                ],
+            )
+
+    def read_batch(self, consumer, limit):
+        """
+        Returns (last id, [(identifier of a app user, message dict)]) of notifications after the consumer's
+        checkpoint. The last id is None if there are no new rows. Malformed rows are skipped, but count in the
+        last id.
+        """
+        connection = self.connect()
+        rows = connection.execute(
+            "SELECT id, app_user_identifier, message FROM offline_notification "
+            "WHERE id > ? ORDER BY id LIMIT ?",
+            (self.get_checkpoint(consumer), limit),
+        ).fetchall()
+        last_id = rows[-1][0] if rows else None
+        offline_notifications = []
+        for row_id, app_user_identifier, message in rows:
+            try:
+                offline_notifications.append((app_user_identifier, json.loads(message)))
+            except ValueError:
+                LOGGER.error(f"Skipping malformed offline notification {row_id}")
+        return last_id, offline_notifications
+
+    def get_checkpoint(self, consumer):
+        row = (
+            self.connect()
+            .execute("SELECT last_id FROM checkpoint WHERE consumer = ?", (consumer,))
+            .fetchone()
+        )
+        return row[0] if row else 0
+
+    def commit_checkpoint(self, consumer, last_id):
+        """
+        Moves the consumer's checkpoint and drops notifications which are already consumed.
+        """
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "INSERT INTO checkpoint (consumer, last_id) VALUES (?, ?) "
+                "ON CONFLICT(consumer) DO UPDATE SET last_id = excluded.last_id",
+                (consumer, last_id),
+            )
+            connection.execute(
+                "DELETE FROM offline_notification WHERE id <= ?", (last_id,)
+            )
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,44 @@
+import hashlib
+
+
+class PresenceDigest:
+    """
+    Order independent digest of a set of app user identifiers, split into BUCKETS_COUNT buckets. Adding and
+    removing an identifier XORs its 64 bit hash into its bucket, so the digest is kept up to date in constant time
+    and two sets can be compared bucket by bucket. The dns and server packages do not import each other, so this
+    module is duplicated in the central router. Both copies must hash the same way.
+    """
+
+    BUCKETS_COUNT = 256
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS_COUNT
+
+    @staticmethod
+    def get_user_hash(application_user_identifier):
+        return int.from_bytes(
+            hashlib.blake2b(
+                application_user_identifier.encode(), digest_size=8
+            ).digest(),
+            "big",
+        )
+
+    @classmethod
+    def get_bucket_index(cls, application_user_identifier):
+        return cls.get_user_hash(application_user_identifier) % cls.BUCKETS_COUNT
+
+    def toggle(self, application_user_identifier) -> int:
+        """
+        Returns the index of the bucket of the app user.
+        """
+        user_hash = self.get_user_hash(application_user_identifier)
+        bucket_index = user_hash % self.BUCKETS_COUNT
+        self.buckets[bucket_index] ^= user_hash
+        return bucket_index
+
+    def get_mismatched_bucket_indexes(self, buckets):
+        return [
+            index
+            for index, bucket in enumerate(self.buckets)
+            if index >= len(buckets) or buckets[index] != bucket
+        ]
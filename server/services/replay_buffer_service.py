@@ -0,0 +1,195 @@
+import asyncio
+import collections
+import json
+import logging
+
+from server.settings import settings
+from server.utils.utils import MessageType
+
+LOGGER = logging.getLogger("Server.ReplayBufferService")
+
+
+class UserReplayBuffer:
+    __slots__ = ("frames", "deferred_notifications", "expiry_task")
+
+    def __init__(self, size):
+        # (Message timestamp identifier or None, message dict, message str), in the order they were routed
+        self.frames = collections.deque(maxlen=size)
+        # Offline notifications of chat messages routed while the app user has no connection, not limited by size
+        self.deferred_notifications = []
+        # Set while the app user has no connection
+        self.expiry_task = None
+
+
+class ReplayBufferService:
+    """
+    Keeps the last BUFFER_SIZE frames routed to every app user of the chat server. When the last connection of an
+    app user closes, the app user stays registered at the central routers for RESUME_WINDOW_SEC, so frames are
+    still buffered. A client which reconnects with the last message timestamp identifier it has seen gets the
+    frames it missed in a single REPLAY message, or a RESYNC message if they are no longer all buffered (it then
+    has to fetch the chat rooms with GET_LAST_CHAT_ROOM_MESSAGE and GET_HISTORY).
+
+    Buffers are kept by the worker, so a client can only resume on the worker it was connected to. Offline
+    notifications of the chat messages routed within the resume window are delayed by RESUME_WINDOW_SEC, and
+    dropped by the central routers if the app user has connected to another chat server meanwhile. Workers of the
+    ChatServerSupervisor share their port (SO_REUSEPORT), so a reconnect rarely reaches the same worker and the
+    supervisor disables resuming if it runs several workers: app users are removed from the central routers as
+    soon as they disconnect and offline notifications are not delayed.
+    """
+
+    BUFFER_SIZE = 50
+    # Can be set with RESUME_WINDOW_SEC in the settings
+    RESUME_WINDOW_SEC = getattr(settings, "RESUME_WINDOW_SEC", 15)
+    # Only these frames carry the identifier of a new message, which clients resume from
+    RESUMABLE_MESSAGE_TYPES = {MessageType.ROUTABLE, MessageType.SYSTEM_ROUTABLE}
+    # Stale after the resume window anyway
+    UNBUFFERED_MESSAGE_TYPES = {MessageType.EPHEMERAL}
+
+    def __init__(self, context):
+        self.context = context
+        self.resume_window_sec = self.RESUME_WINDOW_SEC
+        # Identifier of a app user -> UserReplayBuffer (object)
+        self.user_buffer_dict = {}
+        self.replayed_count = 0
+        self.resync_count = 0
+
+    def open(self, application_user_identifier) -> bool:
+        """
+        Called for every new connection. Returns whether the app user reconnected within the resume window, in
+        which case the app user is still registered at the central routers.
+        """
+        buffer = self.user_buffer_dict.get(application_user_identifier, None)
+        if buffer is None:
+            self.user_buffer_dict[application_user_identifier] = UserReplayBuffer(
+                self.BUFFER_SIZE
+            )
+            self.context.presence_digest_client.toggle(application_user_identifier)
+            return False
+        if buffer.expiry_task is None:
+            return False
+        buffer.expiry_task.cancel()
+        buffer.expiry_task = None
+        buffer.deferred_notifications = []
+        return True
+
+    def disable_resume(self):
+        self.resume_window_sec = 0
+
+    def close(self, application_user_identifier):
+        """
+        Called when the last connection of the app user is closed.
+        """
+        buffer = self.user_buffer_dict.get(application_user_identifier, None)
+        if buffer is not None and buffer.expiry_task is None:
+            buffer.expiry_task = asyncio.create_task(
+                self._expire(application_user_identifier, buffer)
+            )
+
+    def discard(self, application_user_identifier):
+        buffer = self.user_buffer_dict.pop(application_user_identifier, None)
+        if buffer is None:
+            return
+        self.context.presence_digest_client.toggle(application_user_identifier)
+        if buffer.expiry_task is not None:
+            buffer.expiry_task.cancel()
+
+    def reset(self):
+        """
+        Frames routed while a central router link was down are lost, so buffered frames cannot be replayed anymore.
+        """
+        for buffer in self.user_buffer_dict.values():
+            buffer.frames.clear()
+
+    def record(self, application_user_identifier, message: dict, message_str):
+        buffer = self.user_buffer_dict.get(application_user_identifier, None)
+        if buffer is None or message["type"] in self.UNBUFFERED_MESSAGE_TYPES:
+            return
+        message_identifier = (
+            message.get("message_timestamp_identifier", None)
+            if message["type"] in self.RESUMABLE_MESSAGE_TYPES
+            else None
+        )
+        buffer.frames.append((message_identifier, message, message_str))
+        # The central routers do not send offline notifications while the app user is registered
+        if (
+            buffer.expiry_task is not None
+            and message["type"] == MessageType.ROUTABLE
+            and message["app_user_identifier"] != application_user_identifier
+        ):
+            buffer.deferred_notifications.append(
+                {
+                    "chat_room_identifier": message["chat_room_identifier"],
+                    "message": message["message"],
+                    "app_user_identifier": message["app_user_identifier"],
+                }
+            )
+
+    def get_application_user_identifiers(self):
+        """
+        Connected app users and app users within the resume window.
+        """
+        return self.user_buffer_dict.keys()
+
+    def get_replay_message(self, application_user_identifier, last_message_identifier):
+        buffer = self.user_buffer_dict.get(application_user_identifier, None)
+        frames = list(buffer.frames) if buffer is not None else []
+        for index in range(len(frames) - 1, -1, -1):
+            if frames[index][0] == last_message_identifier:
+                self.replayed_count += 1
+                # Frames are already encoded, so they are joined instead of being encoded again
+                payload = ", ".join(frame[2] for frame in frames[index + 1 :])
+                return f'{{"type": "{MessageType.REPLAY}", "payload": [{payload}]}}'
+
+        self.resync_count += 1
+        return json.dumps({"type": MessageType.RESYNC})
+
+    async def replay(self, websocket):
+        """
+        Must be called before anything else is sent to the websocket, so replayed frames come first.
+        """
+        if (
+            websocket.resume_message_identifier is None
+            or websocket.application_user_identifier is None
+        ):
+            return
+        await websocket.send(
+            self.get_replay_message(
+                websocket.application_user_identifier,
+                websocket.resume_message_identifier,
+            )
+        )
+
+    async def _expire(self, application_user_identifier, buffer):
+        await asyncio.sleep(self.resume_window_sec)
+        del self.user_buffer_dict[application_user_identifier]
+        self.context.presence_digest_client.toggle(application_user_identifier)
+        LOGGER.debug(f"Resume window of user {application_user_identifier} ended")
+        # A draining server has already removed all of its users from the central routers at once
+        if self.context.drain_service.is_draining():
+            return
+
+        try:
+            await self.context.central_router_message_service.send_remove_app_user_websocket_message(
+                application_user_identifier
+            )
+            if buffer.deferred_notifications:
+                # Sent after the removal on the same connection, so the central router knows if the app user has
+                # connected to another chat server
+                await self.context.central_router_message_service.send_deferred_offline_notifications_message(
+                    application_user_identifier, buffer.deferred_notifications
+                )
+        except Exception as e:
+            # The app user is removed from the digest, so the central routers repair their presence later
+            LOGGER.exception(
+                f"Cannot remove user {application_user_identifier} from the central routers: {str(e)}"
+            )
+
+    def get_stats(self):
+        stats = {
+            "buffered_users_count": len(self.user_buffer_dict),
+            "replayed_count": self.replayed_count,
+            "resync_count": self.resync_count,
+        }
+        self.replayed_count = 0
+        self.resync_count = 0
+        return stats
@@ -0,0 +1,56 @@
+import asyncio
+
+
+class RequestPipelineMixin:
+    """
+    Handles up to MAX_PIPELINED_REQUESTS messages of one connection concurrently, so a client asking for the
+    history of several chat rooms does not wait for the DynamoDB round trips one after another. Messages with the
+    same ordering key (e.g. chat messages of one chat room) are still handled in the order they were received.
+    When the limit is reached, the connection is not read until a message is handled. Only messages with a request
+    id are pipelined, others are handled in order with run_in_order.
+    """
+
+    MAX_PIPELINED_REQUESTS = 8
+
+    def init_pipeline(self):
+        self.pipeline_semaphore = asyncio.Semaphore(self.MAX_PIPELINED_REQUESTS)
+        self.pipeline_tasks = set()
+        self.ordering_key_task_dict = {}  # Ordering key -> last task with the key
+
+    async def pipeline(self, ordering_key, handler, *args):
+        await self.pipeline_semaphore.acquire()
+        previous_task = (
+            self.ordering_key_task_dict.get(ordering_key, None)
+            if ordering_key is not None
+            else None
+        )
+        task = asyncio.create_task(self._run_pipelined(previous_task, handler, *args))
+        self.pipeline_tasks.add(task)
+        if ordering_key is not None:
+            self.ordering_key_task_dict[ordering_key] = task
+        task.add_done_callback(
+            lambda done_task: self._pipelined_task_done(done_task, ordering_key)
+        )
+
+    async def run_in_order(self, handler, *args):
+        """
+        Handles the message after all pipelined messages, the connection is not read meanwhile.
+        """
+        if self.pipeline_tasks:
+            # Only waits for the tasks, their exceptions are handled by the tasks themselves
+            await asyncio.wait(list(self.pipeline_tasks))
+        await handler(*args)
+
+    async def _run_pipelined(self, previous_task, handler, *args):
+        try:
+            if previous_task is not None:
+                # Only waits for the previous task, its exceptions are handled by the task itself
+                await asyncio.wait([previous_task])
+            await handler(*args)
+        finally:
+            self.pipeline_semaphore.release()
+
+    def _pipelined_task_done(self, task, ordering_key):
+        self.pipeline_tasks.discard(task)
+        if self.ordering_key_task_dict.get(ordering_key, None) is task:
+            del self.ordering_key_task_dict[ordering_key]
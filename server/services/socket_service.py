@@ -12,6 +12,7 @@ class SocketService:
     TOKEN_HEADER = "X-TOKEN"
     TOKEN_PARAMETER = "token"
     MANAGER_HEADER = "X-MANAGER-SECRET"
+    RESUME_PARAMETER = "last_message_timestamp_identifier"
     TOKEN_ERROR_MESSAGE = "X-TOKEN is invalid or expired. Get a new token."
 
     def __init__(self, context):
@@ -54,41 +55,50 @@ class SocketService:
         else:
             return session, None
 
-    async def manage_user_websocket_connection(self, session, websocket) -> (str, str):
-        application_user_identifier = session.application_user_identifier
-        device_identifier = session.device_identifier
+    async def register_websocket_connection(self, websocket):
+        _, is_first_user_connection = self.context.connection_registry.register(
+            websocket,
+            websocket.application_identifier,
+            websocket.application_user_identifier,
+            websocket.device_identifier,
+        )
+        application_user_identifier = websocket.application_user_identifier
+        if application_user_identifier is None:
+            # Manager connection
+            return
+
         LOGGER.debug(
             f"New client connection with identifier {application_user_identifier}"
         )
-
-        if application_user_identifier not in self.context.application_user_device_dict:
-            self.context.application_user_device_dict[application_user_identifier] = {}
-        self.context.application_user_device_dict[application_user_identifier][
-            device_identifier
-        ] = websocket
-
-        await self.context.central_router_message_service.send_add_app_user_websocket_message(
+        is_resumed = self.context.replay_buffer_service.open(
             application_user_identifier
         )
-        return application_user_identifier, device_identifier
+        # The device may have just created a new session with a new fcm token
+        self.context.offline_notification_client.invalidate_fcm_tokens(
+            application_user_identifier
+        )
+        # Within the resume window the app user is still registered at the central routers
+        if is_first_user_connection and not is_resumed:
+            await self.context.central_router_message_service.send_add_app_user_websocket_message(
+                application_user_identifier
+            )
 
-    async def close_user_websocket_connection(self, websocket):
-        if (
-            websocket.application_user_identifier
-            in self.context.application_user_device_dict
-        ):
-            del self.context.application_user_device_dict[
-                websocket.application_user_identifier
-            ][websocket.device_identifier]
-            if not self.context.application_user_device_dict[
-                websocket.application_user_identifier
-            ]:
-                await self.context.central_router_message_service.send_remove_app_user_websocket_message(
-                    websocket.application_user_identifier
-                )
-                del self.context.application_user_device_dict[
-                    websocket.application_user_identifier
-                ]
+    async def close_websocket_connection(self, websocket):
+        connection, is_last_user_connection = (
+            self.context.connection_registry.unregister(websocket)
+        )
+        if not is_last_user_connection:
+            return
+        # A draining server has already removed all of its users from the central routers at once
+        if self.context.drain_service.is_draining():
+            self.context.replay_buffer_service.discard(
+                connection.application_user_identifier
+            )
+        else:
+            # The app user is removed from the central routers when the resume window ends
+            self.context.replay_buffer_service.close(
+                connection.application_user_identifier
+            )
 
     async def validate_manager_header(self, request_headers):
         if self.MANAGER_HEADER not in request_headers:
@@ -97,6 +107,15 @@ class SocketService:
             return True
         return False
 
+    def get_resume_message_identifier(self, path):
+        message_identifier = self.get_from_parameter(path, self.RESUME_PARAMETER)
+        if message_identifier is None:
+            return None
+        try:
+            return int(message_identifier)
+        except ValueError:
+            return None
+
     @staticmethod
     def get_from_parameter(path, header):
         parameters = parse_qs(urlparse(path).query)
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import time
+
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+
+from server.settings import settings
+
+LOGGER = logging.getLogger("Server.WebsocketMemoryProfileService")
+
+
+class WebsocketMemoryProfile:
+    __slots__ = (
+        "max_size",
+        "max_queue",
+        "read_limit",
+        "write_limit",
+        "compression",
+        "compression_window_bits",
+        "compression_mem_level",
+        "compression_min_size",
+        "compression_context_takeover",
+    )
+
+    def __init__(
+        self,
+        max_size=2**20,
+        max_queue=32,
+        read_limit=2**16,
+        write_limit=2**16,
+        compression=True,
+        compression_window_bits=12,
+        compression_mem_level=5,
+        compression_min_size=512,
+        compression_context_takeover=True,
+    ):
+        self.max_size = max_size
+        self.max_queue = max_queue
+        self.read_limit = read_limit
+        self.write_limit = write_limit
+        self.compression = compression
+        self.compression_window_bits = compression_window_bits
+        self.compression_mem_level = compression_mem_level
+        self.compression_min_size = compression_min_size
+        self.compression_context_takeover = compression_context_takeover
+
+    def override(self, overrides):
+        return WebsocketMemoryProfile(
+            **{
+                name: overrides.get(name, getattr(self, name))
+                for name in self.__slots__
+            }
+        )
+
+
+class WebsocketMemoryProfileService:
+    """
+    Buffer sizes and compression of client websockets. Per-connection memory is what limits the number of idle
+    mobile clients a server can hold, so the server wide profile can be overridden per application with the
+    "websocket_memory_profile" application setting (a dict with WebsocketMemoryProfile fields), and connections
+    which have not sent anything for IDLE_SEC are switched to the smaller queue and write buffer of IDLE_PROFILE
+    until their next message. The read buffer limit is set when the connection is made and compression is
+    negotiated in the handshake, so neither can be changed for idle connections.
+    """
+
+    # Can be set with WEBSOCKET_MAX_SIZE, WEBSOCKET_MAX_QUEUE, WEBSOCKET_READ_LIMIT and WEBSOCKET_WRITE_LIMIT in
+    # the settings
+    SERVER_PROFILE = WebsocketMemoryProfile(
+        max_size=getattr(settings, "WEBSOCKET_MAX_SIZE", 2**20),
+        max_queue=getattr(settings, "WEBSOCKET_MAX_QUEUE", 32),
+        read_limit=getattr(settings, "WEBSOCKET_READ_LIMIT", 2**16),
+        write_limit=getattr(settings, "WEBSOCKET_WRITE_LIMIT", 2**16),
+    )
+    # Only the queue and the write buffer are shrunk, the message size limit of a connection is kept while it is
+    # idle. Can be set with WEBSOCKET_IDLE_MAX_QUEUE and WEBSOCKET_IDLE_WRITE_LIMIT in the settings
+    IDLE_PROFILE = SERVER_PROFILE.override(
+        {
+            "max_queue": getattr(settings, "WEBSOCKET_IDLE_MAX_QUEUE", 4),
+            "write_limit": getattr(settings, "WEBSOCKET_IDLE_WRITE_LIMIT", 2**12),
+        }
+    )
+    # Can be set with WEBSOCKET_IDLE_SEC in the settings
+    IDLE_SEC = getattr(settings, "WEBSOCKET_IDLE_SEC", 5 * 60)
+    IDLE_CHECK_SEC_INTERVAL = 60
+    # Rough size of the websocket protocol, transport and registry objects of a connection
+    CONNECTION_OVERHEAD_BYTES = 8 * 1024
+    # Inflate state besides the sliding window
+    INFLATE_OVERHEAD_BYTES = 7 * 1024
+
+    def __init__(self, context):
+        self.context = context
+
+    def get_serve_kwargs(self):
+        """
+        Arguments of websockets serve(). Compression is negotiated per connection, see ChatServerProtocol.
+        """
+        return {
+            "max_size": self.SERVER_PROFILE.max_size,
+            "max_queue": self.SERVER_PROFILE.max_queue,
+            "read_limit": self.SERVER_PROFILE.read_limit,
+            "write_limit": self.SERVER_PROFILE.write_limit,
+            "compression": None,
+        }
+
+    def get_application_profile(self, application_identifier):
+        application_settings = (
+            self.context.applications_service.get_applications_settings().get(
+                application_identifier, None
+            )
+        )
+        overrides = (
+            application_settings.get("websocket_memory_profile", None)
+            if application_settings
+            else None
+        )
+        if not overrides:
+            return self.SERVER_PROFILE
+        return self.SERVER_PROFILE.override(overrides)
+
+    def apply_profile(self, websocket, profile):
+        # The read buffer limit is set when the connection is made, so only the server wide value is used. The
+        # message size limit is not shrunk for idle connections
+        if profile is not self.IDLE_PROFILE:
+            websocket.max_size = profile.max_size
+        websocket.max_queue = profile.max_queue
+        websocket.write_limit = profile.write_limit
+        if websocket.transport is not None:
+            websocket.transport.set_write_buffer_limits(profile.write_limit)
+
+    def mark_active(self, websocket):
+        websocket.last_message_at = time.monotonic()
+        if websocket.is_idle:
+            websocket.is_idle = False
+            self.apply_profile(websocket, websocket.memory_profile)
+
+    async def handle(self):
+        while True:
+            await asyncio.sleep(self.IDLE_CHECK_SEC_INTERVAL)
+            idle_since = time.monotonic() - self.IDLE_SEC
+            idle_count = 0
+            websockets = self.context.connection_registry.get_user_websockets_list()
+            for websocket in websockets:
+                if not websocket.is_idle and websocket.last_message_at < idle_since:
+                    websocket.is_idle = True
+                    self.apply_profile(websocket, self.IDLE_PROFILE)
+                    idle_count += 1
+            if idle_count:
+                LOGGER.debug(
+                    f"Switched {idle_count} idle connections to the idle profile"
+                )
+
+    def estimate_connection_memory(self, websocket):
+        """
+        Rough estimate of the memory used by a single connection in bytes.
+        """
+        memory = self.CONNECTION_OVERHEAD_BYTES
+        memory += sum(len(message) for message in websocket.messages)
+        if websocket.transport is not None:
+            memory += websocket.transport.get_write_buffer_size()
+        for extension in websocket.extensions:
+            if isinstance(extension, PerMessageDeflate):
+                # zlib: deflate needs (1 << (window bits + 2)) + (1 << (mem level + 9)), inflate the window
+                compress_settings = extension.compress_settings or {}
+                memory += (1 << ((extension.local_max_window_bits or 15) + 2)) + (
+                    1 << (compress_settings.get("memLevel", 8) + 9)
+                )
+                memory += (
+                    1 << (extension.remote_max_window_bits or 15)
+                ) + self.INFLATE_OVERHEAD_BYTES
+        return memory
+
+    def get_stats(self):
+        websockets = self.context.connection_registry.get_user_websockets_list()
+        estimated_memory = sum(
+            self.estimate_connection_memory(websocket) for websocket in websockets
+        )
+        return {
+            "connections_count": len(websockets),
+            "idle_connections_count": len([e for e in websockets if e.is_idle]),
+            "estimated_memory_bytes": estimated_memory,
+            "estimated_memory_per_connection_bytes": (
+                estimated_memory // len(websockets) if websockets else 0
+            ),
+        }
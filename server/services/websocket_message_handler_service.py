@@ -1,23 +1,44 @@
-import json
+import asyncio
 import logging
+import random
+import time
 
-from server.services.websocket_message_service import WebsocketMessageService
+from websockets.exceptions import WebSocketException
+
+from server.services.message_schema import MESSAGE_SCHEMAS
+from server.services.websocket_message_service import (
+    WebsocketMessage,
+    WebsocketMessageService,
+)
 from server.utils.exceptions import (
     ChatRoomIdentifiersListLengthException,
+    InvalidMessageFormat,
     MissingRequiredFieldException,
+    ServerOverloadedException,
 )
-from server.utils.utils import DecimalEncoder, MessageType, ChatRoomType
+from server.utils.utils import MessageType, ChatRoomType
 
 LOGGER = logging.getLogger("Server.WebSocketMessageService")
 
 
 class WebSocketMessageHandlerService:
+    # Message type -> event loop lag (ms) above which the message type is rejected. Chat messages are never shed.
+    SHEDDING_LAG_THRESHOLDS_MS = {
+        MessageType.EPHEMERAL: 50,
+        MessageType.GET_HISTORY: 100,
+        MessageType.GET_UNREAD_MESSAGES_COUNT: 150,
+        MessageType.GET_LAST_CHAT_ROOM_MESSAGE: 200,
+    }
+    MIN_RETRY_AFTER_MS = 1000
+    MAX_RETRY_AFTER_MS = 30000
+    RETRY_AFTER_LAG_MULTIPLIER = 20
 
     def __init__(self, context):
         self.context = context
         self.websocket_message_service = WebsocketMessageService(self.context)
         self.message_type_handlers = {
             MessageType.ROUTABLE: self.chat_message_handler,
+            MessageType.EPHEMERAL: self.ephemeral_message_handler,
             MessageType.GET_HISTORY: self.get_history_message_handler,
             MessageType.SET_LAST_MESSAGE_READ: self.set_last_message_read_handler,
             MessageType.GET_LAST_MESSAGES_READ: self.get_last_messages_read_handler,
@@ -27,6 +48,7 @@ class WebSocketMessageHandlerService:
         self.chat_room_type_handler_permissions = {
             ChatRoomType.REGULAR: [
                 MessageType.ROUTABLE,
+                MessageType.EPHEMERAL,
                 MessageType.GET_HISTORY,
                 MessageType.SET_LAST_MESSAGE_READ,
                 MessageType.GET_LAST_MESSAGES_READ,
@@ -37,13 +59,38 @@ class WebSocketMessageHandlerService:
             ChatRoomType.MASS_PRIVATE: [MessageType.ROUTABLE, MessageType.GET_HISTORY],
         }
 
-    async def handle_message(self, message, websocket):
-        message_type = message.get("type", None)
+    async def handle_message(self, message_dict, websocket):
+        message_type = message_dict.get("type", None)
         if not message_type:
             raise MissingRequiredFieldException("type")
+        message_schema = MESSAGE_SCHEMAS.get(message_type, None)
+        if message_schema is None:
+            raise InvalidMessageFormat()
+        # Malformed messages are rejected before they reach DynamoDB
+        message = message_schema.decode(message_dict)
+        self.shed_load(message_type)
         return await self.message_type_handlers[message_type](message, websocket)
 
-    async def chat_message_handler(self, message: dict, websocket):
+    def shed_load(self, message_type):
+        shedding_lag_threshold_ms = self.SHEDDING_LAG_THRESHOLDS_MS.get(
+            message_type, None
+        )
+        if shedding_lag_threshold_ms is None:
+            return
+        lag_ms = self.context.loop_lag_monitor_client.get_lag_ms()
+        if lag_ms <= shedding_lag_threshold_ms:
+            return
+
+        # Jitter spreads the retries of all rejected clients
+        retry_after_ms = min(
+            max(lag_ms * self.RETRY_AFTER_LAG_MULTIPLIER, self.MIN_RETRY_AFTER_MS),
+            self.MAX_RETRY_AFTER_MS,
+        )
+        retry_after_ms = int(random.uniform(retry_after_ms, 2 * retry_after_ms))
+        LOGGER.debug(f"Shedding {message_type} message, event loop lag {lag_ms} ms")
+        raise ServerOverloadedException(message_type, retry_after_ms)
+
+    async def chat_message_handler(self, message: WebsocketMessage, websocket):
         # Format
         # {
         #     'type': 'ROUTABLE',
@@ -52,16 +99,74 @@ class WebSocketMessageHandlerService:
         # }
         LOGGER.debug("Received ROUTABLE message from client.")
         message_data = await self.websocket_message_service.manage_websocket_message(
-            websocket, message, ["message", "chat_room_identifier"]
+            websocket, message
         )
-        # Persist the message in dynamoDB
-        message_identifier = await self.context.dynamodb_service.create_chat_message(
-            message_data.chat_room_identifier,
-            message_data.application_user_identifier,
-            message_data.message,
+        message_identifier = time.time_ns()  # Unix time in nanoseconds (!)
+        # The custom data is fetched while the message is persisted. The message is routed only once it is stored,
+        # so other users never get a message which is not in the history.
+        _, custom_data = await asyncio.gather(
+            self.context.dynamodb_service.create_chat_message(
+                message_data.chat_room_identifier,
+                message_data.application_user_identifier,
+                message_data.message,
+                message_identifier,
+            ),
+            self.context.custom_data_cache_service.get_custom_data(
+                message_data.application_user_identifier
+            ),
+        )
+        try:
+            await self.route_chat_message(message_data, message_identifier, custom_data)
+        except WebSocketException as e:
+            # The message is stored, so the sender must not send it again. Other users get it from the history.
+            LOGGER.warning(
+                f"Cannot route stored message {message_identifier}: {str(e)}"
+            )
+        # The sender knows the message is stored, before the last message read record is written
+        await self.websocket_message_service.send_response(
+            websocket,
+            message_data,
+            {
+                "type": MessageType.SENT,
+                "chat_room_identifier": message_data.chat_room_identifier,
+                "message_timestamp_identifier": message_identifier,
+            },
+        )
+        if message_data.chat_room_type in (
+            ChatRoomType.MASS_PUBLIC,
+            ChatRoomType.MASS_PRIVATE,
+        ):
+            return
+        await self.websocket_message_service.send_set_last_message_read(
+            message_data, message_identifier
         )
 
-        # Send message to other users in the chat room, via a central router
+    async def ephemeral_message_handler(self, message: WebsocketMessage, websocket):
+        # Format
+        # {
+        #     'type': 'EPHEMERAL',
+        #     'chat_room_identifier': str,
+        #     'message': str
+        # }
+        # Used for typing indicators and presence pings, which are not persisted and not sent as offline
+        # notifications
+        message_data = await self.websocket_message_service.manage_websocket_message(
+            websocket, message
+        )
+        central_router_message = {
+            "type": MessageType.EPHEMERAL,
+            "chat_room_identifier": message_data.chat_room_identifier,
+            "app_user_identifier": message_data.application_user_identifier,
+            "application_user_identifiers": message_data.application_user_identifiers,
+            "message": message_data.message,
+        }
+        await self.context.central_router_client.send_message(central_router_message)
+
+    async def route_chat_message(
+        self, message_data: WebsocketMessage, message_identifier, custom_data
+    ):
+        # Send message to other users in the chat room, via a central router. Messages of MASS chat rooms carry all
+        # the app users of the chat room too, see DnsMessageManager.PER_SERVER_ROUTING_MIN_USERS_COUNT
         central_router_message = {
             "type": MessageType.ROUTABLE,
             "chat_room_identifier": message_data.chat_room_identifier,
@@ -69,17 +174,13 @@ class WebSocketMessageHandlerService:
             "application_user_identifiers": message_data.application_user_identifiers,
             "message_timestamp_identifier": message_identifier,
             "message": message_data.message,
-            "custom_data": await self.context.custom_data_cache_service.get_custom_data(
-                message_data.application_user_identifier
-            ),
+            "custom_data": custom_data,
         }
         await self.context.central_router_client.send_message(central_router_message)
-        # TODO If chat room type is MASS dont save last message read record
-        await self.websocket_message_service.send_set_last_message_read(
-            message_data, message_identifier
-        )
 
-    async def get_last_messages_read_handler(self, message: dict, websocket):
+    async def get_last_messages_read_handler(
+        self, message: WebsocketMessage, websocket
+    ):
         #
         # This one is used to get identifiers of last messages read by all users in the chat room. For example
         # if there are 3 users: A, B and C in the chatroom, we return 3 message IDs (for users A, B and C respectively)
@@ -91,7 +192,7 @@ class WebSocketMessageHandlerService:
         # }
         LOGGER.debug("Received GET_LAST_MESSAGES_READ message from client.")
         message_data = await self.websocket_message_service.manage_websocket_message(
-            websocket, message, ["chat_room_identifier"]
+            websocket, message
         )
 
         last_messages_read = (
@@ -99,14 +200,14 @@ class WebSocketMessageHandlerService:
                 message_data.chat_room_identifier
             )
         )
-        payload = (
+        response = (
             await self.websocket_message_service.prepare_last_messages_read_message(
                 last_messages_read
             )
         )
-        await websocket.send(payload)
+        await self.websocket_message_service.send_response(websocket, message, response)
 
-    async def set_last_message_read_handler(self, message: dict, websocket):
+    async def set_last_message_read_handler(self, message: WebsocketMessage, websocket):
         #
         #  Using this to mark a message as LAST message read by the current user.
         #
@@ -117,14 +218,13 @@ class WebSocketMessageHandlerService:
         # }
         LOGGER.debug("Received SET_LAST_MESSAGE_READ message from client.")
         message_data = await self.websocket_message_service.manage_websocket_message(
-            websocket, message, ["chat_room_identifier", "message_timestamp_identifier"]
+            websocket, message
         )
-        message_identifier = int(message_data.message_timestamp_identifier)
         await self.websocket_message_service.send_set_last_message_read(
-            message_data, message_identifier
+            message_data, message_data.message_timestamp_identifier
         )
 
-    async def get_history_message_handler(self, message: dict, websocket):
+    async def get_history_message_handler(self, message: WebsocketMessage, websocket):
         #
         # Using this to pull historical messages from given chatroom
         #
@@ -136,23 +236,22 @@ class WebSocketMessageHandlerService:
         # }
         LOGGER.debug("Received HISTORY message from client.")
         message_data = await self.websocket_message_service.manage_websocket_message(
-            websocket,
-            message,
-            ["chat_room_identifier", "from_message_timestamp_identifier"],
+            websocket, message
         )
-        limit = int(message.get("limit", 20))
 
         history = await self.context.dynamodb_service.fetch_chat_room_messages(
             message_data.chat_room_identifier,
-            int(message_data.from_message_timestamp_identifier),
-            limit,
+            message_data.from_message_timestamp_identifier,
+            message_data.limit,
         )
-        payload = await self.websocket_message_service.prepare_history_message(
+        response = await self.websocket_message_service.prepare_history_message(
             history, message_data.chat_room_identifier
         )
-        await websocket.send(payload)
+        await self.websocket_message_service.send_response(websocket, message, response)
 
-    async def get_last_chat_room_message_handler(self, message: dict, websocket):
+    async def get_last_chat_room_message_handler(
+        self, message: WebsocketMessage, websocket
+    ):
         #
         # Using this to get last chat room message
         #
@@ -162,7 +261,7 @@ class WebSocketMessageHandlerService:
         # }
         result = []
         message_data = await self.websocket_message_service.manage_websocket_message(
-            websocket, message, ["chat_room_identifiers"], validate_user=False
+            websocket, message, validate_user=False
         )
 
         for chat_room_identifier in message_data.chat_room_identifiers:
@@ -182,10 +281,13 @@ class WebSocketMessageHandlerService:
             "type": MessageType.GET_LAST_CHAT_ROOM_MESSAGE,
             "payload": result,
         }
-        payload = json.dumps(result_message, cls=DecimalEncoder)
-        await websocket.send(payload)
+        await self.websocket_message_service.send_response(
+            websocket, message, result_message
+        )
 
-    async def get_unread_messages_count_message_handler(self, message: dict, websocket):
+    async def get_unread_messages_count_message_handler(
+        self, message: WebsocketMessage, websocket
+    ):
         #
         # Using this to get count of unread messages in chat rooms
         #
@@ -195,7 +297,7 @@ class WebSocketMessageHandlerService:
         # }
         result = []
         message_data = await self.websocket_message_service.manage_websocket_message(
-            websocket, message, ["chat_room_identifiers"], validate_user=False
+            websocket, message, validate_user=False
         )
         if len(message_data.chat_room_identifiers) > 10:
             raise ChatRoomIdentifiersListLengthException()
@@ -217,5 +319,6 @@ class WebSocketMessageHandlerService:
             "type": MessageType.GET_UNREAD_MESSAGES_COUNT,
             "payload": result,
         }
-        payload = json.dumps(result_message, cls=DecimalEncoder)
-        await websocket.send(payload)
+        await self.websocket_message_service.send_response(
+            websocket, message, result_message
+        )
@@ -1,29 +1,36 @@
-import json
 import time
 from decimal import Decimal
 
 from server.utils.exceptions import (
     UserNotInChatRoomException,
-    MissingRequiredFieldException,
     InvalidChatRoomMessageTypeException,
     ChatRoomDoesNotExistsException,
 )
-from server.utils.utils import MessageType, DecimalEncoder, ChatRoomType
+from server.utils.utils import MessageType, ChatRoomType
 
 
 class WebsocketMessage:
-
-    type = None
-    message = None
-    chat_room_identifier = None
-    chat_room_identifiers = None
-    message_timestamp_identifier = None
-    from_message_timestamp_identifier = None
-
-    # Dynamodb objects
-    application_user_identifiers = None
-    application_user_identifier = None
-    device_identifier = None
+    """
+    Base of the slotted message structs decoded by MessageSchema. Fields below are filled in by the chat server.
+    """
+
+    __slots__ = (
+        "type",
+        "request_id",
+        # Dynamodb objects
+        "application_user_identifiers",
+        "application_user_identifier",
+        "device_identifier",
+        "chat_room_type",
+    )
+
+    def __init__(self, message_type, request_id=None):
+        self.type = message_type
+        self.request_id = request_id
+        self.application_user_identifiers = None
+        self.application_user_identifier = None
+        self.device_identifier = None
+        self.chat_room_type = None
 
 
 class WebsocketMessageService:
@@ -33,33 +40,24 @@ class WebsocketMessageService:
         self.last_message_read_limit = 100
 
     async def manage_websocket_message(
-        self, websocket, message_dict, fields, validate_user=True
+        self, websocket, message: WebsocketMessage, validate_user=True
     ) -> WebsocketMessage:
         """
-        Converts websocket message into data class, additionally adding custom fields. If validate_user flag
-        also validates if user belong to provided chat room.
+        Adds the app user of the websocket to the decoded message. If validate_user flag also validates if user
+        belong to provided chat room.
         """
-        result = WebsocketMessage()
-        result.application_user_identifier = websocket.application_user_identifier
-        result.device_identifier = websocket.device_identifier
+        message.application_user_identifier = websocket.application_user_identifier
+        message.device_identifier = websocket.device_identifier
 
         if validate_user:
-            chat_room_identifier = message_dict.get("chat_room_identifier", None)
-            if not chat_room_identifier:
-                raise MissingRequiredFieldException("chat_room_identifier")
-            application_user_identifiers = await self.validate_users_in_chat_room(
-                result.application_user_identifier,
-                chat_room_identifier,
-                method_type=message_dict["type"],
+            chat_room = await self.get_validated_chat_room(
+                message.application_user_identifier,
+                message.chat_room_identifier,
+                method_type=message.type,
             )
-            result.application_user_identifiers = application_user_identifiers
-
-        for field in fields:
-            value = message_dict.get(field, None)
-            if not value:
-                raise MissingRequiredFieldException(field)
-            setattr(result, field, value)
-        return result
+            message.application_user_identifiers = chat_room["app_users"]
+            message.chat_room_type = int(chat_room.get("type", ChatRoomType.REGULAR))
+        return message
 
     async def validate_users_in_chat_room(
         self, application_user_identifier, chat_room_identifier, method_type
@@ -67,7 +65,15 @@ class WebsocketMessageService:
         """
         Find other users in the chat room. It also validates if current user is in the chat room
         """
-        chat_room = await self.context.dynamodb_service.fetch_chat_room(
+        chat_room = await self.get_validated_chat_room(
+            application_user_identifier, chat_room_identifier, method_type
+        )
+        return chat_room["app_users"]
+
+    async def get_validated_chat_room(
+        self, application_user_identifier, chat_room_identifier, method_type
+    ):
+        chat_room = await self.context.chat_room_cache_service.get_chat_room(
             chat_room_identifier
         )
         if not chat_room:
@@ -80,7 +86,7 @@ class WebsocketMessageService:
                 raise UserNotInChatRoomException(
                     chat_room_identifier, application_user_identifier
                 )
-        return chat_room["app_users"]
+        return chat_room
 
     async def validate_chat_room_type_handler_permission(self, chat_room, method_type):
         chat_room_type = int(chat_room.get("type", ChatRoomType.REGULAR))
@@ -116,6 +122,14 @@ class WebsocketMessageService:
         }
         await self.context.central_router_client.send_message(central_router_message)
 
+    async def send_response(self, websocket, message: WebsocketMessage, response):
+        """
+        Sends the response to the client with the request id of the message it responds to, if the client set one.
+        """
+        if message.request_id is not None:
+            response["request_id"] = message.request_id
+        await websocket.send(await self.context.json_encoding_service.dumps(response))
+
     async def prepare_last_messages_read_message(self, last_messages_read):
         for last_message in last_messages_read:
             identifier = last_message.get("app_user_identifier", None)
@@ -127,11 +141,10 @@ class WebsocketMessageService:
                 )
             del last_message["identifier"]
 
-        result = {
+        return {
             "type": MessageType.GET_LAST_MESSAGES_READ,
             "payload": last_messages_read,
         }
-        return json.dumps(result, cls=DecimalEncoder)
 
     async def prepare_history_message(self, history, chat_room_identifier):
         for message in history:
@@ -143,12 +156,11 @@ class WebsocketMessageService:
                     )
                 )
 
-        result = {
+        return {
             "type": MessageType.GET_HISTORY,
             "chat_room_identifier": chat_room_identifier,
             "payload": history,
         }
-        return json.dumps(result, cls=DecimalEncoder)
 
     async def get_chat_room_last_message_info(
         self, chat_room_identifier, message_data: WebsocketMessage
@@ -82,7 +82,7 @@ class DnsConnectionsException(CustomException):
 
 
 class MessageSpamException(CustomException):
-    message = "Message spam detected: the rate exceeded 300 messages per minute. Server will close the socket."
+    message = "Message spam detected: the message rate limit was exceeded. Server will close the socket."
     error_code = 10007
 
 
@@ -101,3 +101,47 @@ class InvalidChatRoomMessageTypeException(CustomException):
 class ChatRoomDoesNotExistsException(CustomException):
     message = "Chat room does not exists."
     error_code = 10009
+
+
+class ServerOverloadedException(CustomException):
+    message = (
+        "Server is overloaded. Message was not handled, retry after the given time."
+    )
+    error_code = 10010
+
+    def __init__(self, message_type, retry_after_ms):
+        self.message_type = message_type
+        self.retry_after_ms = retry_after_ms
+
+    def get_extra(self):
+        return {
+            "message_type": self.message_type,
+            "retry_after_ms": self.retry_after_ms,
+        }
+
+
+class MessageRateLimitedException(CustomException):
+    message = "Message rate limit exceeded. Message was not handled, retry after the given time."
+    error_code = 10012
+
+    def __init__(self, message_type, retry_after_ms):
+        self.message_type = message_type
+        self.retry_after_ms = retry_after_ms
+
+    def get_extra(self):
+        return {
+            "message_type": self.message_type,
+            "retry_after_ms": self.retry_after_ms,
+        }
+
+
+class InvalidFieldException(CustomException):
+    message = "Invalid field value."
+    error_code = 10011
+
+    def __init__(self, field_name, expected_type):
+        self.field_name = field_name
+        self.expected_type = expected_type
+
+    def get_extra(self):
+        return {"field_name": self.field_name, "expected_type": self.expected_type}
@@ -0,0 +1,70 @@
+import asyncio
+import random
+
+from aiohttp import web
+
+
+class FakeFcmServer:
+    """
+    Local stand-in for the FCM legacy HTTP endpoint, used in tests and throughput benchmarks. Device tokens
+    starting with "unregistered" or "invalid" are rejected the same way FCM rejects them.
+    """
+
+    def __init__(
+        self, server_key="fake-server-key", latency_sec=0.0, unavailable_ratio=0.0
+    ):
+        self.server_key = server_key
+        self.latency_sec = latency_sec
+        self.unavailable_ratio = unavailable_ratio
+        self.requests_count = 0
+        self.notifications_count = 0
+        self.runner = None
+        self.url = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application()
+        app.router.add_post("/fcm/send", self.send_handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/fcm/send"
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def send_handler(self, request):
+        if request.headers.get("Authorization", None) != f"key={self.server_key}":
+            return web.Response(status=401, text="Unauthorized")
+        if self.latency_sec:
+            await asyncio.sleep(self.latency_sec)
+
+        payload = await request.json()
+        self.requests_count += 1
+
+        results = []
+        for registration_id in payload["registration_ids"]:
+            if registration_id.startswith("unregistered"):
+                results.append({"error": "NotRegistered"})
+            elif registration_id.startswith("invalid"):
+                results.append({"error": "InvalidRegistration"})
+            elif random.random() < self.unavailable_ratio:
+                results.append({"error": "Unavailable"})
+            else:
+                self.notifications_count += 1
+                results.append({"message_id": f"0:{self.notifications_count}"})
+
+        success = len([e for e in results if "message_id" in e])
+        return web.json_response(
+            {
+                "multicast_id": self.requests_count,
+                "success": success,
+                "failure": len(results) - success,
+                "canonical_ids": 0,
+                "results": results,
+            }
+        )
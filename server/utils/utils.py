@@ -1,8 +1,7 @@
 import decimal
 import json
 import logging
-
-from aiohttp import ClientConnectionError
+import time
 
 from server.settings.settings import CHAT_API_URL
 from server.utils.exceptions import CustomException
@@ -24,6 +23,23 @@ class MessageType:
     GET_LAST_CHAT_ROOM_MESSAGE = "GET_LAST_CHAT_ROOM_MESSAGE"
     GET_UNREAD_MESSAGES_COUNT = "GET_UNREAD_MESSAGES_COUNT"
     SYSTEM_ROUTABLE = "SYSTEM_ROUTABLE"
+    INVALIDATE = "INVALIDATE"
+    DRAIN = "DRAIN"
+    SENT = "SENT"
+    REPLAY = "REPLAY"
+    RESYNC = "RESYNC"
+    EPHEMERAL = "EPHEMERAL"
+    PRESENCE_DIGEST = "PRESENCE_DIGEST"
+    PRESENCE_DIGEST_MISMATCH = "PRESENCE_DIGEST_MISMATCH"
+    PRESENCE_BUCKETS_SYNC = "PRESENCE_BUCKETS_SYNC"
+    DEFERRED_OFFLINE_NOTIFICATIONS = "DEFERRED_OFFLINE_NOTIFICATIONS"
+
+
+class InvalidationType:
+    CUSTOM_DATA = "CUSTOM_DATA"
+    FCM_TOKENS = "FCM_TOKENS"
+    CHAT_ROOM = "CHAT_ROOM"
+    APPLICATION_SETTINGS = "APPLICATION_SETTINGS"
 
 
 class ChatRoomType:
@@ -39,35 +55,45 @@ class DecimalEncoder(json.JSONEncoder):
         return super(DecimalEncoder, self).default(o)
 
 
-async def send_error(custom_exception: CustomException, websocket):
-    payload = {"type": MessageType.ERROR, "exception": custom_exception.get_message()}
-    await websocket.send(json.dumps(payload))
+class TokenBucket:
+    """
+    Allows bursts of up to `capacity` tokens, refilled at `rate` tokens per second. Uses the monotonic clock, so
+    it is not affected by changes of the system time.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def consume(self, tokens=1):
+        self._refill()
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def get_wait_sec(self, tokens=1):
+        """
+        Seconds until `tokens` tokens are available.
+        """
+        self._refill()
+        return max(tokens - self.tokens, 0) / self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
 
 
-async def make_server_call(session, url, method="get", **kwargs):
-    try:
-        async with getattr(session, method)(url, **kwargs) as resp:
-            if resp.status == 500 or resp.status == 502:
-                LOGGER.error(
-                    f"Internal server error (HTTP {resp.status}) in the Chat API service {url}"
-                )
-                return []
-
-            response = await resp.json()
-            if resp.status != 200:
-                LOGGER.warning(
-                    f"Error (HTTP {resp.status}) in the Chat API service {url}: {response}"
-                )
-                return []
-            return response
-    except ClientConnectionError:
-        LOGGER.warning(f"Cannot connect to the Chat API service at url: {url}")
-        return []
-    except Exception as e:
-        LOGGER.exception(
-            f"Unknown exception in the Chat API service at url: {url}, message: {str(e)}"
-        )
-        return []
+async def send_error(custom_exception: CustomException, websocket, request_id=None):
+    payload = {"type": MessageType.ERROR, "exception": custom_exception.get_message()}
+    if request_id is not None:
+        payload["request_id"] = request_id
+    await websocket.send(json.dumps(payload))
 
 
 def prepare_server_url(path):